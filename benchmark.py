@@ -0,0 +1,323 @@
+import argparse
+import contextlib
+import io
+import json
+import math
+import os
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib.parse import urlsplit, parse_qs
+
+import main
+
+# Офлайн-бенчмарк: локальные заглушки hh.ru и Telegram Bot API, без обращения к живым сервисам.
+# Каждый сценарий запускается в отдельном процессе, чтобы пиковый RSS был честным.
+#
+#   python benchmark.py                       # все сценарии на 1k/10k/100k
+#   python benchmark.py --scenarios fetch,persist --sizes 1000
+#   python benchmark.py --tg-latency 0.02 --tg-429-rate 0.05
+
+SCENARIOS = ["fetch", "parse", "persist", "render", "publish"]
+CITIES = list(main.HHruParser.CITIES)
+BASE_TIME = datetime(2026, 1, 1, tzinfo=timezone(timedelta(hours=3)))
+
+
+def synthetic_item(area, index, base_time=BASE_TIME, step=60):
+    published = base_time - timedelta(seconds=index * step)
+    salary = None
+    if index % 3:
+        # Уникальная зарплата - чтобы синтетические вакансии не считались перепостами друг друга
+        salary = {"from": 30000 + index * 10, "to": None if index % 2 else 10 ** 7,
+                  "currency": "RUR" if index % 7 else "USD"}
+    return {
+        "id": f"{area}{index:07d}",
+        "name": f"Вакансия {index % 977} <разработчик> & тестировщик",
+        "employer": {"name": f"Компания \"{index % 311}\""},
+        "salary": salary,
+        "alternate_url": f"https://hh.ru/vacancy/{area}{index:07d}",
+        "published_at": published.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        "area": {"id": str(area), "name": f"Город {area}"},
+    }
+
+
+def synthetic_page(area, page, per_page, total, first=0, base_time=BASE_TIME, step=60):
+    start = first + page * per_page
+    items = [synthetic_item(area, i, base_time, step) for i in range(start, min(start + per_page, total))]
+    found = max(0, total - first)
+    return {"items": items, "found": found, "pages": math.ceil(found / per_page) if per_page else 0,
+            "page": page, "per_page": per_page}
+
+
+def parse_date(value):
+    return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z")
+
+
+class FakeHHHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        # Вакансия i опубликована в base_time - i * step; окно date_from/date_to переводится
+        # в диапазон индексов, как фильтр по датам у настоящего hh.ru. Глубина не ограничена.
+        server = self.server
+        url = urlsplit(self.path)
+        query = parse_qs(url.query)
+        if server.latency:
+            time.sleep(server.latency)
+        if url.path.endswith("/professional_roles"):
+            payload = {"categories": [{"id": "1", "roles": [{"id": str(i)} for i in range(1, 6)]}]}
+        else:
+            area = int(query.get("area", ["0"])[0])
+            page = int(query.get("page", ["0"])[0])
+            per_page = int(query.get("per_page", ["20"])[0])
+            first, total = 0, server.per_area
+            if "date_to" in query:
+                first = max(0, math.ceil((server.base_time - parse_date(query["date_to"][0])).total_seconds()
+                                         / server.step))
+            if "date_from" in query:
+                last = int((server.base_time - parse_date(query["date_from"][0])).total_seconds() // server.step)
+                total = max(first, min(total, last + 1))
+            payload = synthetic_page(area, page, per_page, total, first, server.base_time, server.step)
+        body = json.dumps(payload).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeTelegramHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, code, payload):
+        body = json.dumps(payload).encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self._reply(200, {"ok": True, "result": {"id": 1, "username": "bench_bot"}})
+
+    def do_POST(self):
+        server = self.server
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        if server.latency:
+            time.sleep(server.latency)
+        with server.lock:
+            server.requests += 1
+            message_id = server.requests
+            limited = server.rng.random() < server.error_rate
+            server.rate_limited += limited
+        if limited:
+            self._reply(429, {"ok": False, "error_code": 429,
+                              "description": "Too Many Requests: retry after 0",
+                              "parameters": {"retry_after": server.retry_after}})
+        else:
+            self._reply(200, {"ok": True, "result": {"message_id": message_id}})
+
+
+def start_server(handler, **attrs):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    server.daemon_threads = True
+    server.lock = threading.Lock()
+    for name, value in attrs.items():
+        setattr(server, name, value)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def percentile(samples, q):
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(round(q / 100 * (len(ordered) - 1))))]
+
+
+def timed(samples, fn):
+    def wrapper(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            samples.append(time.perf_counter() - started)
+    return wrapper
+
+
+def synthetic_vacancies(parser, size):
+    per_area = math.ceil(size / len(CITIES))
+    vacancies = []
+    for area in CITIES:
+        area_id = parser.get_city_id(area)
+        vacancies.extend(parser._parse_item(synthetic_item(area_id, i), area) for i in range(per_area))
+    return vacancies[:size]
+
+
+def scenario_fetch(size, args, workdir):
+    # Вакансии равномерно раскладываются по 30 дням; крупные запросы режет CrawlPlanner
+    per_area = math.ceil(size / len(CITIES))
+    base_time = datetime.now().astimezone().replace(microsecond=0) - timedelta(minutes=1)
+    server = start_server(FakeHHHandler, latency=args.hh_latency, per_area=per_area, base_time=base_time,
+                          step=max(1, 29 * 86400 // per_area))
+    parser = main.HHruParser(base_url=f"http://127.0.0.1:{server.server_port}/vacancies")
+    db = main.VacancyDatabase(os.path.join(workdir, "fetch.db"))
+    planner = main.CrawlPlanner(parser, db)
+    samples = []
+    parser._get = timed(samples, parser._get)
+    started = time.perf_counter()
+    jobs = planner.plan_many(main.build_fetch_jobs(CITIES))
+    vacancies = parser.fetch_many(jobs)
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    db.close()
+    return len(vacancies), elapsed, samples, f"HTTP-запрос ({len(samples)} запросов)"
+
+
+def scenario_parse(size, args, workdir):
+    parser = main.HHruParser()
+    per_area = math.ceil(size / len(CITIES))
+    pages = [synthetic_page(parser.get_city_id(area), page, 50, per_area)
+             for area in CITIES for page in range(math.ceil(per_area / 50))]
+    raw = [json.dumps(page) for page in pages]
+    samples = []
+    count = 0
+    started = time.perf_counter()
+    for body in raw:
+        page_started = time.perf_counter()
+        data = json.loads(body)
+        count += len([parser._parse_item(item, "") for item in data["items"]])
+        samples.append(time.perf_counter() - page_started)
+    elapsed = time.perf_counter() - started
+    return count, elapsed, samples, "разбор страницы из 50"
+
+
+def scenario_persist(size, args, workdir):
+    db = main.VacancyDatabase(os.path.join(workdir, "bench.db"))
+    vacancies = synthetic_vacancies(main.HHruParser(), size)
+    samples = []
+    inserted = 0
+    started = time.perf_counter()
+    for i in range(0, len(vacancies), 50):
+        batch_started = time.perf_counter()
+        inserted += len(db.save_vacancies(vacancies[i:i + 50]))
+        samples.append(time.perf_counter() - batch_started)
+    elapsed = time.perf_counter() - started
+    db.close()
+    return inserted, elapsed, samples, "запись пачки из 50"
+
+
+def scenario_render(size, args, workdir):
+    # Пакетный рендер, как при заполнении нового канала накопленными вакансиями
+    renderer = main.VacancyRenderer()
+    vacancies = synthetic_vacancies(main.HHruParser(), size)
+    samples = []
+    rendered = 0
+    started = time.perf_counter()
+    for i in range(0, len(vacancies), 1000):
+        batch_started = time.perf_counter()
+        rendered += len(renderer.render_many(vacancies[i:i + 1000]))
+        samples.append(time.perf_counter() - batch_started)
+    elapsed = time.perf_counter() - started
+    return rendered, elapsed, samples, "рендер пачки из 1000"
+
+
+def scenario_publish(size, args, workdir):
+    server = start_server(FakeTelegramHandler, latency=args.tg_latency, error_rate=args.tg_429_rate,
+                          retry_after=0, requests=0, rate_limited=0, rng=random.Random(42))
+    # Лимиты Telegram здесь сняты: измеряем собственные накладные расходы публикации
+    limiter = main.TelegramRateLimiter(global_rate=10 ** 6, chat_rate=10 ** 6, chat_per_minute=10 ** 8)
+    publisher = main.TelegramChannelPublisher("bench", rate_limiter=limiter, pool_size=args.channels,
+                                              api_base=f"http://127.0.0.1:{server.server_port}")
+    samples = []
+    publisher.send_to_channel = timed(samples, publisher.send_to_channel)
+    # Каждая вакансия идёт во все каналы; из каждого канала отправляется своя доля, через захват в очереди
+    channels = [f"@bench_{i}" for i in range(args.channels)]
+    db = main.VacancyDatabase(os.path.join(workdir, "publish.db"),
+                              router=main.ChannelRouter([main.ChannelRule(channel) for channel in channels]))
+    db.save_vacancies(synthetic_vacancies(main.HHruParser(), size))
+    queue = main.PublishQueue(publisher, main.Outbox(db))
+    for channel in channels:
+        queue.put(channel, size // args.channels)
+    started = time.perf_counter()
+    results = queue.run()
+    elapsed = time.perf_counter() - started
+    server.shutdown()
+    db.close()
+    sent = sum(len(ids) for ids in results.values())
+    return sent, elapsed, samples, f"отправка (429: {server.rate_limited})"
+
+
+def run_scenario(name, size, args):
+    handler = globals()[f"scenario_{name}"]
+    with tempfile.TemporaryDirectory() as workdir:
+        with contextlib.redirect_stdout(io.StringIO()):
+            count, elapsed, samples, unit = handler(size, args, workdir)
+    return {
+        "scenario": name,
+        "size": size,
+        "items": count,
+        "seconds": elapsed,
+        "throughput": count / elapsed if elapsed else 0.0,
+        "p50_ms": percentile(samples, 50) * 1000,
+        "p99_ms": percentile(samples, 99) * 1000,
+        "unit": unit,
+        # ru_maxrss в Linux - килобайты
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def main_cli():
+    cli = argparse.ArgumentParser(description="Офлайн-бенчмарк агрегатора вакансий")
+    cli.add_argument("--scenarios", default=",".join(SCENARIOS))
+    cli.add_argument("--sizes", default="1000,10000,100000")
+    cli.add_argument("--hh-latency", type=float, default=0.005, help="задержка заглушки hh.ru, с")
+    cli.add_argument("--tg-latency", type=float, default=0.002, help="задержка заглушки Telegram, с")
+    cli.add_argument("--tg-429-rate", type=float, default=0.01, help="доля ответов 429")
+    cli.add_argument("--channels", type=int, default=4, help="число каналов при публикации")
+    cli.add_argument("--json", action="store_true", help="вывести результаты в JSON")
+    cli.add_argument("--run", help=argparse.SUPPRESS)
+    cli.add_argument("--size", type=int, help=argparse.SUPPRESS)
+    args = cli.parse_args()
+
+    if args.run:
+        print(json.dumps(run_scenario(args.run, args.size, args)))
+        return 0
+
+    results = []
+    passthrough = [f"--hh-latency={args.hh_latency}", f"--tg-latency={args.tg_latency}",
+                   f"--tg-429-rate={args.tg_429_rate}", f"--channels={args.channels}"]
+    for name in [s.strip() for s in args.scenarios.split(",") if s.strip()]:
+        for size in [int(s) for s in args.sizes.split(",") if s.strip()]:
+            proc = subprocess.run([sys.executable, __file__, "--run", name, "--size", str(size)] + passthrough,
+                                  capture_output=True, text=True)
+            if proc.returncode != 0:
+                print(f"✗ {name} / {size}: {proc.stderr.strip().splitlines()[-1]}")
+                return 1
+            result = json.loads(proc.stdout.strip().splitlines()[-1])
+            results.append(result)
+            if not args.json:
+                print(f"{name:8} {size:>7} | {result['items']:>7} шт за {result['seconds']:8.3f} с | "
+                      f"{result['throughput']:>10.0f} шт/с | p50 {result['p50_ms']:8.3f} мс | "
+                      f"p99 {result['p99_ms']:8.3f} мс | RSS {result['peak_rss_mb']:7.1f} МБ | {result['unit']}")
+    if args.json:
+        print(json.dumps(results, ensure_ascii=False, indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main_cli())
@@ -1,54 +1,474 @@
 import os
+import argparse
+import re
+import logging
+import html
+import json
+import math
+import gzip
+import hashlib
 import sqlite3
-import requests
 import time
 import signal
 import sys
+import heapq
+import itertools
+import traceback
 import random  # <-- ДОБАВЛЕНО
+import queue
+import threading
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime, timedelta
 from contextlib import contextmanager
+from functools import lru_cache
+from urllib.parse import urlsplit
 
 # import schedule  <-- УДАЛЕНО (больше не нужен)
 
 
+# Одна поисковая задача: город (название или id области hh.ru), текст запроса, глубина в днях.
+# date_from/date_to (datetime) сужают окно - так работают инкрементальная загрузка и нарезка
+# запроса планировщиком; params - дополнительные фильтры hh.ru парами (ключ, значение)
+FetchJob = namedtuple("FetchJob", ["area", "text", "period_days", "date_from", "date_to", "params"],
+                      defaults=(None, None, ()))
+
+
+def parse_published_at(value):
+    # hh.ru отдаёт даты вида 2024-01-15T10:30:00+0300
+    if not value:
+        return None
+    try:
+        value = value.split('.')[0].replace('Z', '+00:00')
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S%z")
+    except ValueError:
+        return None
+
+
+def published_timestamp(value):
+    published = parse_published_at(value)
+    return int(published.timestamp()) if published is not None else None
+
+
+def http_session(pool_connections=1, pool_maxsize=8, headers=None):
+    # requests (~0.1 с на импорт) загружается при первом сетевом запросе, а не при старте процесса
+    import requests
+
+    session = requests.Session()
+    adapter = requests.adapters.HTTPAdapter(pool_connections=pool_connections, pool_maxsize=pool_maxsize)
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    if headers:
+        session.headers.update(headers)
+    return session
+
+
+def build_fetch_jobs(cities, queries=None, period_days=30):
+    queries = list(queries or []) or [None]
+    return [FetchJob(city, text, period_days) for city in cities for text in queries]
+
+
+logger = logging.getLogger("perm_vacancies")
+LOG_JSON = False
+
+
+def configure_logging(fmt="text", level="INFO"):
+    global LOG_JSON
+    LOG_JSON = fmt == "json"
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(logging.Formatter("%(message)s"))
+    logger.handlers[:] = [handler]
+    logger.setLevel(getattr(logging, str(level).upper(), logging.INFO))
+    logger.propagate = False
+
+
+def log(level, message, exc_info=False, **fields):
+    # Сообщение - шаблон str.format: при выключенном уровне не форматируется вовсе.
+    # exc_info=True добавляет трассировку текущего исключения
+    if not logger.isEnabledFor(level):
+        return
+    if LOG_JSON:
+        record = {"ts": datetime.now().isoformat(timespec="milliseconds"),
+                  "level": logging.getLevelName(level), "event": message.strip()}
+        record.update(fields)
+        if exc_info:
+            record["traceback"] = traceback.format_exc()
+        logger.log(level, json.dumps(record, ensure_ascii=False, default=str))
+    else:
+        logger.log(level, message.format(**fields), exc_info=exc_info)
+
+
+def log_separator():
+    # Разделитель нужен только в выводе для человека
+    if not LOG_JSON:
+        log(logging.INFO, "=" * 60)
+
+
+class Metrics:
+    # Счётчики и гистограммы в памяти процесса, отдаются в текстовом формате Prometheus
+    BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters = {}
+        self._histograms = {}
+        self._gauges = {}
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = [[0] * len(self.BUCKETS), 0.0, 0]
+            buckets, _, _ = histogram
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    buckets[i] += 1
+                    break
+            histogram[1] += value
+            histogram[2] += 1
+
+    def gauge(self, name, func, **labels):
+        # Значение читается при каждом запросе /metrics
+        with self._lock:
+            self._gauges[self._key(name, labels)] = func
+
+    @contextmanager
+    def timer(self, stage):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe("stage_duration_seconds", time.perf_counter() - started, stage=stage)
+
+    @staticmethod
+    def _escape(value):
+        return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+    @classmethod
+    def _labels(cls, labels, extra=()):
+        pairs = list(labels) + list(extra)
+        if not pairs:
+            return ""
+        return "{" + ",".join(f'{k}="{cls._escape(v)}"' for k, v in pairs) + "}"
+
+    def render(self):
+        with self._lock:
+            counters = dict(self._counters)
+            histograms = {key: (list(h[0]), h[1], h[2]) for key, h in self._histograms.items()}
+            gauges = dict(self._gauges)
+        lines = []
+        # Строка # TYPE - один раз на метрику, перед всеми её рядами
+        typed = set()
+
+        def declare(name, kind):
+            if name not in typed:
+                typed.add(name)
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in sorted(counters.items()):
+            declare(name, "counter")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), func in sorted(gauges.items(), key=lambda item: item[0]):
+            try:
+                value = func()
+            except Exception:
+                continue
+            declare(name, "gauge")
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), (buckets, total, count) in sorted(histograms.items()):
+            declare(name, "histogram")
+            cumulative = 0
+            for bound, bucket in zip(self.BUCKETS, buckets):
+                cumulative += bucket
+                lines.append(f"{name}_bucket{self._labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels, [('le', '+Inf')])} {count}")
+            lines.append(f"{name}_sum{self._labels(labels)} {total}")
+            lines.append(f"{name}_count{self._labels(labels)} {count}")
+        return "\n".join(lines) + "\n"
+
+
+METRICS = Metrics()
+
+
+def start_api_server(port, host="127.0.0.1", analytics=None):
+    from flask import Flask, Response, request
+
+    app = Flask("perm_vacancies_api")
+
+    @app.route("/metrics")
+    def metrics():
+        return Response(METRICS.render(), mimetype="text/plain; version=0.0.4")
+
+    def analytics_args():
+        weeks = request.args.get("weeks", type=int)
+        return {"city": request.args.get("city"), "role": request.args.get("role"), "weeks": weeks}
+
+    def json_response(data):
+        return Response(json.dumps(data, ensure_ascii=False), mimetype="application/json")
+
+    if analytics is not None:
+        # /analytics/salary?city=Пермь&role=96&weeks=4 - перцентили; /analytics/salary/trend - по неделям
+        @app.route("/analytics/salary")
+        def salary_percentiles():
+            return json_response(analytics.percentiles(**analytics_args()))
+
+        @app.route("/analytics/salary/trend")
+        def salary_trend():
+            args = analytics_args()
+            args["weeks"] = args["weeks"] or 12
+            return json_response(analytics.trend(**args))
+
+    # make_server вместо app.run: Flask печатает баннер запуска в stdout, а там только события log()
+    from werkzeug.serving import make_server
+    server = make_server(host, port, app, threaded=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    log(logging.INFO, "Метрики: http://{host}:{port}/metrics", host=host, port=port)
+    if analytics is not None:
+        log(logging.INFO, "Аналитика зарплат: http://{host}:{port}/analytics/salary", host=host, port=port)
+    return app
+
+
 class GracefulExit:
     def __init__(self):
-        self.exit_now = False
+        self._event = threading.Event()
         signal.signal(signal.SIGINT, self.signal_handler)
         signal.signal(signal.SIGTERM, self.signal_handler)
 
+    @property
+    def exit_now(self):
+        return self._event.is_set()
+
+    @exit_now.setter
+    def exit_now(self, value):
+        if value:
+            self._event.set()
+        else:
+            self._event.clear()
+
+    def wait(self, timeout=None):
+        # True - пришёл сигнал выхода, False - истёк таймаут
+        return self._event.wait(max(0, timeout) if timeout is not None else None)
+
     def signal_handler(self, signum, frame):
-        print(f"\nПолучен сигнал {signum}. Завершаю работу...")
+        log(logging.INFO, "\nПолучен сигнал {signum}. Завершаю работу...", signum=signum)
         self.exit_now = True
 
 
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def try_acquire(self):
+        # 0 - токен получен, иначе сколько секунд подождать до следующей попытки
+        with self._lock:
+            now = time.monotonic()
+            if now < self.blocked_until:
+                return self.blocked_until - now
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0
+            return (1 - self.tokens) / self.rate
+
+    def block_for(self, seconds):
+        with self._lock:
+            self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+            self.updated = max(self.updated, self.blocked_until)
+
+
+class TelegramRateLimiter:
+    # Лимиты Bot API: ~30 сообщений в секунду всего, в один чат - 1 в секунду и 20 в минуту
+    def __init__(self, global_rate=30, chat_rate=1, chat_per_minute=20):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_per_minute = chat_per_minute
+        self._chats = {}
+        self._lock = threading.Lock()
+
+    def _chat_buckets(self, chat_id):
+        with self._lock:
+            buckets = self._chats.get(chat_id)
+            if buckets is None:
+                buckets = (TokenBucket(self.chat_rate, 1),
+                           TokenBucket(self.chat_per_minute / 60, self.chat_per_minute))
+                self._chats[chat_id] = buckets
+        return buckets
+
+    def acquire(self, chat_id, should_stop=None):
+        for bucket in self._chat_buckets(chat_id) + (self.global_bucket,):
+            wait = bucket.try_acquire()
+            while wait > 0:
+                if should_stop and should_stop():
+                    return False
+                time.sleep(min(wait, 0.5))
+                wait = bucket.try_acquire()
+        return True
+
+    def retry_after(self, chat_id, seconds):
+        for bucket in self._chat_buckets(chat_id):
+            bucket.block_for(seconds)
+
+
+@lru_cache(maxsize=8192)
+def format_published(published_at):
+    published = parse_published_at(published_at)
+    return published.strftime("%d.%m.%Y %H:%M") if published is not None else "Недавно"
+
+
+class VacancyRenderer:
+    CURRENCY_SYMBOLS = {'RUR': '₽', 'RUB': '₽', 'USD': '$', 'EUR': '€', 'KZT': '₸'}
+    ESCAPE_TABLE = str.maketrans({
+        '&': '&amp;',
+        '<': '&lt;',
+        '>': '&gt;',
+        '"': '&quot;',
+        "'": '&#39;',
+    })
+    TEMPLATE = (
+        "<b>{title}</b>\n"
+        "\n"
+        "🏢 <b>Компания:</b> {company}\n"
+        "💰 <b>Зарплата:</b> {salary}\n"
+        "📍 <b>Город:</b> {city}\n"
+        "📅 <b>Опубликовано:</b> {published}\n"
+        "\n"
+        "🔗 <a href=\"{url}\">Подробнее на сайте</a>\n"
+        "\n"
+        "#вакансия #{source}"
+    )
+
+    def __init__(self):
+        self._format = self.TEMPLATE.format
+
+    def escape(self, text):
+        return str(text).translate(self.ESCAPE_TABLE) if text else ""
+
+    def format_salary(self, salary_data):
+        if not salary_data:
+            return "Не указана"
+        salary_from = salary_data.get('from')
+        salary_to = salary_data.get('to')
+        currency = salary_data.get('currency') or ''
+        currency_display = self.CURRENCY_SYMBOLS.get(currency.upper(), currency)
+        if salary_from and salary_to:
+            return f"{salary_from:,} - {salary_to:,} {currency_display}".replace(',', ' ')
+        elif salary_from:
+            return f"от {salary_from:,} {currency_display}".replace(',', ' ')
+        elif salary_to:
+            return f"до {salary_to:,} {currency_display}".replace(',', ' ')
+        else:
+            return "Не указана"
+
+    SALARY_PATTERN = re.compile(r"^(?:(от|до) )?(\d[\d ]*?)(?: - (\d[\d ]*?))? (\S+)$")
+
+    @classmethod
+    def parse_salary(cls, text):
+        # Обратное к format_salary: (from, to, currency) из строки вида "от 50 000 ₽"
+        match = cls.SALARY_PATTERN.match(text or "")
+        if not match:
+            return None, None, None
+        prefix, first, second, symbol = match.groups()
+        first = int(first.replace(' ', ''))
+        second = int(second.replace(' ', '')) if second else None
+        currency = next((code for code, display in cls.CURRENCY_SYMBOLS.items() if display == symbol), symbol)
+        if prefix == "до":
+            return None, first, currency
+        return first, second, currency
+
+    def render(self, vacancy):
+        escape = self.escape
+        return self._format(
+            title=escape(vacancy.get('title', 'Без названия'))[:200],
+            company=escape(vacancy.get('company', 'Не указано'))[:100],
+            salary=escape(vacancy.get('salary', 'Не указана'))[:100],
+            city=escape(vacancy.get('city', 'Не указан'))[:50],
+            published=format_published(vacancy.get('published_at') or ''),
+            url=vacancy.get('url', '#'),
+            source=vacancy.get('source', 'hh').replace('.ru', ''),
+        )
+
+    def render_many(self, vacancies):
+        return [self.render(vacancy) for vacancy in vacancies]
+
+
 class TelegramChannelPublisher:
-    def __init__(self, bot_token):
+    def __init__(self, bot_token, rate_limiter=None, pool_size=8, api_base="https://api.telegram.org"):
         self.bot_token = bot_token
-        self.api_url = f"https://api.telegram.org/bot{bot_token}"
+        self.api_url = f"{api_base}/bot{bot_token}"
         self.exit_flag = False
-
-    def check_bot(self):
+        self.rate_limiter = rate_limiter or TelegramRateLimiter()
+        self.renderer = VacancyRenderer()
+        self.pool_size = pool_size
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._bot_checked_at = None
+
+    @property
+    def session(self):
+        # Одна keep-alive сессия на все отправки вместо нового соединения на каждое сообщение
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = http_session(1, self.pool_size)
+        return self._session
+
+    def check_bot(self, max_age=3600):
+        # Успешный getMe запоминается на max_age секунд: проверка перед каждым циклом бесплатна
+        if self._bot_checked_at is not None and time.monotonic() - self._bot_checked_at < max_age:
+            return True
         url = f"{self.api_url}/getMe"
         try:
-            response = requests.get(url, timeout=10)
+            response = self.session.get(url, timeout=10)
             data = response.json()
             if data.get("ok"):
-                print(f"✓ Бот @{data['result']['username']} работает")
+                log(logging.INFO, "✓ Бот @{username} работает", username=data['result']['username'])
+                self._bot_checked_at = time.monotonic()
                 return True
             else:
-                print(f"✗ Ошибка бота: {data.get('description')}")
+                log(logging.ERROR, "✗ Ошибка бота: {error}", error=data.get('description'))
                 return False
         except Exception as e:
-            print(f"✗ Ошибка проверки бота: {e}")
+            log(logging.ERROR, "✗ Ошибка проверки бота: {error}", error=e)
             return False
 
-    def send_to_channel(self, channel_username, vacancy, retry_count=2):
+    def _sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self.exit_flag:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            time.sleep(min(remaining, 0.1))
+
+    def send_to_channel(self, channel_username, vacancy, retry_count=2, max_rate_limited=5, renew_lease=None):
+        # Возвращает message_id, None - отправлено, но id не прочитан, False - не отправлено.
+        # renew_lease вызывается перед каждой попыткой: ожидания лимитов могут пережить аренду строки
+        import requests
+
         if self.exit_flag:
-            print("Получен запрос на выход, пропускаю отправку")
+            log(logging.INFO, "Получен запрос на выход, пропускаю отправку", channel=channel_username)
             return False
 
-        message = self.format_vacancy_message(vacancy)
+        # Текст сообщения рендерится один раз при вставке в БД, здесь его остаётся только прочитать
+        message = vacancy.get('message_text')
+        if not message:
+            with METRICS.timer("render"):
+                message = self.format_vacancy_message(vacancy)
         url = f"{self.api_url}/sendMessage"
         payload = {
             "chat_id": channel_username,
@@ -58,220 +478,1712 @@ class TelegramChannelPublisher:
             "disable_notification": True
         }
 
-        for attempt in range(retry_count):
+        attempt = 0
+        rate_limited = 0
+        response = None
+        while attempt < retry_count:
+            if not self.rate_limiter.acquire(channel_username, lambda: self.exit_flag):
+                return False
+            if renew_lease is not None and not renew_lease():
+                log(logging.WARNING, "✗ Аренда вакансии {vacancy_id} истекла, отправку выполнит другой исполнитель",
+                    channel=channel_username, vacancy_id=vacancy['id'])
+                return False
+            if attempt or rate_limited:
+                METRICS.inc("telegram_retries_total", channel=channel_username)
             try:
-                response = requests.post(url, json=payload, timeout=15)
+                with METRICS.timer("send"):
+                    response = self.session.post(url, json=payload, timeout=15)
                 if response.status_code == 200:
-                    print(f"✓ Отправлено в канал {channel_username}: {vacancy['title'][:50]}...")
-                    return True
-                else:
-                    error_data = response.json()
-                    print(f"✗ Ошибка Telegram API (попытка {attempt+1}/{retry_count}): {error_data.get('description', response.text)}")
-                    if "chat not found" in str(error_data).lower():
-                        print(f"✗ Канал {channel_username} не найден или бот не является администратором")
-                        return False
-                    if attempt < retry_count - 1:
-                        time.sleep(2)
+                    break
+                error_data = response.json()
+                if response.status_code == 429 and rate_limited < max_rate_limited:
+                    # 429 не считается неудачной попыткой: ждём ровно столько, сколько просит Telegram
+                    rate_limited += 1
+                    retry_after = error_data.get("parameters", {}).get("retry_after", 1)
+                    METRICS.inc("telegram_rate_limited_total", channel=channel_username)
+                    log(logging.WARNING, "✗ Лимит Telegram для {channel}, жду {retry_after} с",
+                        channel=channel_username, retry_after=retry_after)
+                    self.rate_limiter.retry_after(channel_username, retry_after)
+                    continue
+                attempt += 1
+                log(logging.WARNING, "✗ Ошибка Telegram API (попытка {attempt}/{retry_count}): {error}",
+                    attempt=attempt, retry_count=retry_count, channel=channel_username,
+                    status=response.status_code, error=error_data.get('description', response.text))
+                if "chat not found" in str(error_data).lower():
+                    log(logging.ERROR, "✗ Канал {channel} не найден или бот не является администратором",
+                        channel=channel_username)
+                    break
+                if attempt < retry_count:
+                    self._sleep(2)
             except requests.exceptions.Timeout:
-                print(f"✗ Таймаут (попытка {attempt+1}/{retry_count})")
-                if attempt < retry_count - 1:
-                    time.sleep(2)
+                attempt += 1
+                log(logging.WARNING, "✗ Таймаут (попытка {attempt}/{retry_count})",
+                    attempt=attempt, retry_count=retry_count, channel=channel_username)
+                if attempt < retry_count:
+                    self._sleep(2)
             except requests.exceptions.ConnectionError:
-                print(f"✗ Ошибка соединения (попытка {attempt+1}/{retry_count})")
-                if attempt < retry_count - 1:
-                    time.sleep(3)
+                attempt += 1
+                log(logging.WARNING, "✗ Ошибка соединения (попытка {attempt}/{retry_count})",
+                    attempt=attempt, retry_count=retry_count, channel=channel_username)
+                if attempt < retry_count:
+                    self._sleep(3)
             except KeyboardInterrupt:
-                print("\nПрервано пользователем")
+                log(logging.INFO, "\nПрервано пользователем")
                 self.exit_flag = True
                 return False
             except Exception as e:
-                print(f"✗ Неожиданная ошибка (попытка {attempt+1}/{retry_count}): {e}")
-                if attempt < retry_count - 1:
-                    time.sleep(2)
-        return False
-
-    def format_vacancy_message(self, vacancy):
-        def escape_html(text):
-            if not text:
-                return ""
-            return (str(text)
-                    .replace('&', '&amp;')
-                    .replace('<', '&lt;')
-                    .replace('>', '&gt;')
-                    .replace('"', '&quot;')
-                    .replace("'", '&#39;'))
-
-        title = escape_html(vacancy.get('title', 'Без названия'))[:200]
-        company = escape_html(vacancy.get('company', 'Не указано'))[:100]
-        salary = escape_html(vacancy.get('salary', 'Не указана'))[:100]
-        city = escape_html(vacancy.get('city', 'Не указан'))[:50]
-        url = vacancy.get('url', '#')
-
-        published = vacancy.get('published_at', '')
-        if published:
-            try:
-                published = published.split('.')[0].replace('Z', '+00:00')
-                dt = datetime.strptime(published, "%Y-%m-%dT%H:%M:%S%z")
-                published_str = dt.strftime("%d.%m.%Y %H:%M")
-            except:
-                published_str = "Недавно"
-        else:
-            published_str = "Недавно"
-
-        message = f"""
-<b>{title}</b>
-
-🏢 <b>Компания:</b> {company}
-💰 <b>Зарплата:</b> {salary}
-📍 <b>Город:</b> {city}
-📅 <b>Опубликовано:</b> {published_str}
+                attempt += 1
+                log(logging.WARNING, "✗ Неожиданная ошибка (попытка {attempt}/{retry_count}): {error}",
+                    attempt=attempt, retry_count=retry_count, channel=channel_username, error=e)
+                if attempt < retry_count:
+                    self._sleep(2)
+        if response is None or response.status_code != 200:
+            METRICS.inc("telegram_failed_total", channel=channel_username)
+            return False
 
-🔗 <a href="{url}">Подробнее на сайте</a>
+        # Сообщение уже в канале: нечитаемый ответ не повод отправлять его ещё раз
+        METRICS.inc("telegram_sent_total", channel=channel_username)
+        try:
+            message_id = response.json()["result"]["message_id"]
+        except Exception as e:
+            message_id = None
+            log(logging.WARNING, "✗ Не удалось прочитать message_id: {error}", channel=channel_username,
+                vacancy_id=vacancy['id'], error=e)
+        log(logging.INFO, "✓ Отправлено в канал {channel}: {title}...",
+            channel=channel_username, title=vacancy['title'][:50], vacancy_id=vacancy['id'], message_id=message_id)
+        return message_id
 
-#вакансия #{vacancy.get('source', 'hh').replace('.ru', '')}
-"""
-        return message.strip()
+    def format_vacancy_message(self, vacancy):
+        return self.renderer.render(vacancy)
+
+
+class Outbox:
+    # Очередь channel_posts с арендой: строка захватывается в отдельной транзакции до отправки,
+    # поэтому несколько потоков и процессов разбирают очередь без двойных публикаций.
+    # Если процесс упал с захваченной строкой, по истечении аренды её заберёт другой исполнитель.
+    def __init__(self, db, worker_id=None, lease_seconds=300, base_delay=60, max_delay=6 * 3600, max_attempts=8):
+        self.db = db
+        self.worker_id = worker_id or f"{os.getpid()}-{hashlib.md5(os.urandom(8)).hexdigest()[:8]}"
+        self.lease_seconds = lease_seconds
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.max_attempts = max_attempts
+
+    def claim(self, channel):
+        return self.db.claim_channel_post(channel, self.worker_id, self.lease_seconds)
+
+    def renew(self, channel, vacancy_id):
+        return self.db.renew_channel_post(channel, vacancy_id, self.worker_id)
+
+    def complete(self, channel, vacancy_id, message_id):
+        return self.db.complete_channel_post(channel, vacancy_id, message_id, self.worker_id)
+
+    def fail(self, channel, vacancy, error=None):
+        attempts = vacancy.get('attempts', 1)
+        if attempts >= self.max_attempts:
+            log(logging.WARNING, "    Вакансия {vacancy_id} снята с публикации в {channel} после {attempts} попыток",
+                vacancy_id=vacancy['id'], channel=channel, attempts=attempts)
+            self.db.fail_channel_post(channel, vacancy['id'], self.worker_id, error, None)
+            return
+        # Экспоненциальная задержка со случайным разбросом, чтобы исполнители не повторяли синхронно
+        delay = min(self.max_delay, self.base_delay * 2 ** (attempts - 1)) * random.uniform(0.5, 1.0)
+        self.db.fail_channel_post(channel, vacancy['id'], self.worker_id, error, int(time.time() + delay))
+
+    def release(self, channel=None, vacancy_id=None):
+        # Возврат без штрафа: отправка не состоялась из-за остановки
+        return self.db.release_channel_posts(self.worker_id, channel, vacancy_id)
+
+
+class PublishQueue:
+    def __init__(self, publisher, outbox, exit_controller=None):
+        self.publisher = publisher
+        self.outbox = outbox
+        self.exit_controller = exit_controller
+        self._channels = {}
+
+    def put(self, channel_username, limit):
+        self._channels[channel_username] = limit
+
+    def __len__(self):
+        return sum(self._channels.values())
+
+    def _stopped(self):
+        if self.exit_controller is not None and self.exit_controller.exit_now:
+            self.publisher.exit_flag = True
+        return self.publisher.exit_flag
+
+    def _drain_channel(self, channel_username, limit):
+        sent = []
+        while len(sent) < limit:
+            if self._stopped():
+                log(logging.INFO, "Получен запрос на выход, прерываю публикацию в {channel}...",
+                    channel=channel_username)
+                break
+            vacancy = self.outbox.claim(channel_username)
+            if vacancy is None:
+                break
+            message_id = self.publisher.send_to_channel(
+                channel_username, vacancy, renew_lease=lambda: self.outbox.renew(channel_username, vacancy['id']))
+            if message_id is not False:
+                if not self.outbox.complete(channel_username, vacancy['id'], message_id):
+                    log(logging.WARNING, "    Аренда вакансии {vacancy_id} в {channel} потеряна после отправки",
+                        vacancy_id=vacancy['id'], channel=channel_username)
+                sent.append(vacancy['id'])
+            elif self._stopped():
+                self.outbox.release(channel_username, vacancy['id'])
+            else:
+                log(logging.WARNING, "    Не удалось отправить вакансию {vacancy_id} в {channel}",
+                    vacancy_id=vacancy['id'], channel=channel_username)
+                self.outbox.fail(channel_username, vacancy, "send failed")
+        return sent
+
+    def run(self):
+        # Каналы обслуживаются параллельно, темп задаёт только TelegramRateLimiter
+        channels, self._channels = self._channels, {}
+        results = {}
+        if not channels:
+            return results
+        try:
+            with ThreadPoolExecutor(max_workers=len(channels)) as pool:
+                futures = {pool.submit(self._drain_channel, channel, limit): channel
+                           for channel, limit in channels.items()}
+                for future in as_completed(futures):
+                    channel = futures[future]
+                    try:
+                        results[channel] = future.result()
+                    except Exception as e:
+                        log(logging.ERROR, "✗ Ошибка публикации в {channel}: {error}", channel=channel, error=e)
+                        results[channel] = []
+        finally:
+            # Всё, что осталось захваченным этим исполнителем, сразу возвращается в очередь
+            self.outbox.release()
+        return results
 
 
 class HHruParser:
-    def __init__(self):
-        self.base_url = "https://api.hh.ru/vacancies"
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
-        })
+    PER_PAGE = 50
+    MAX_DEPTH = 2000
+    CITIES = {
+        'Пермь': 72,
+        'Москва': 1,
+        'Санкт-Петербург': 2,
+        'Екатеринбург': 3,
+        'Новосибирск': 4,
+        'Казань': 88,
+        'Нижний Новгород': 66,
+    }
+
+    def __init__(self, max_workers=8, per_host_limit=4, base_url="https://api.hh.ru/vacancies", cache=None):
+        self.base_url = base_url
+        self.cache = cache
+        self.renderer = VacancyRenderer()
+        self.max_workers = max_workers
+        self.per_host_limit = per_host_limit
+        self._host_limits = {}
+        self._host_lock = threading.Lock()
+        self._roles = None
+        self._session = None
+        self._session_lock = threading.Lock()
+
+    @property
+    def session(self):
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    self._session = http_session(4, self.max_workers, {
+                        'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'
+                    })
+        return self._session
 
     def get_city_id(self, city_name="Пермь"):
-        cities = {
-            'Пермь': 72,
-            'Москва': 1,
-            'Санкт-Петербург': 2,
-            'Екатеринбург': 3,
-            'Новосибирск': 4,
-            'Казань': 88,
-            'Нижний Новгород': 66,
-        }
-        return cities.get(city_name, 59)
+        return self.CITIES.get(city_name, 59)
 
     def format_salary(self, salary_data):
-        if not salary_data:
-            return "Не указана"
-        salary_from = salary_data.get('from')
-        salary_to = salary_data.get('to')
-        currency = salary_data.get('currency', '')
-        symbols = {'RUR': '₽', 'RUB': '₽', 'USD': '$', 'EUR': '€', 'KZT': '₸'}
-        currency_display = symbols.get(currency.upper(), currency)
-        if salary_from and salary_to:
-            return f"{salary_from:,} - {salary_to:,} {currency_display}".replace(',', ' ')
-        elif salary_from:
-            return f"от {salary_from:,} {currency_display}".replace(',', ' ')
-        elif salary_to:
-            return f"до {salary_to:,} {currency_display}".replace(',', ' ')
+        return self.renderer.format_salary(salary_data)
+
+    def _host_semaphore(self, url):
+        host = urlsplit(url).netloc
+        with self._host_lock:
+            semaphore = self._host_limits.get(host)
+            if semaphore is None:
+                semaphore = threading.BoundedSemaphore(self.per_host_limit)
+                self._host_limits[host] = semaphore
+        return semaphore
+
+    def _get(self, url, params=None, timeout=20, max_age=0):
+        # Не больше per_host_limit одновременных запросов к одному хосту
+        with self._host_semaphore(url):
+            if self.cache is not None:
+                return self.cache.get(self.session, url, params=params, timeout=timeout, max_age=max_age)
+            return self.session.get(url, params=params, timeout=timeout)
+
+    def _parse_item(self, item, city):
+        return {
+            "id": str(item["id"]),
+            "title": item.get("name", "").strip(),
+            "company": item.get("employer", {}).get("name", "").strip(),
+            "salary": self.format_salary(item.get("salary")),
+            "url": item.get("alternate_url", f"https://hh.ru/vacancy/{item['id']}"),
+            "published_at": item.get("published_at", ""),
+            "source": "hh.ru",
+            "city": item.get("area", {}).get("name", city),
+            "salary_from": (item.get("salary") or {}).get("from"),
+            "salary_to": (item.get("salary") or {}).get("to"),
+            "salary_currency": (item.get("salary") or {}).get("currency"),
+            "role": next((role.get("id") for role in item.get("professional_roles") or ()), None),
+        }
+
+    def job_window(self, job):
+        # Округление до минуты делает URL стабильным между запусками - это нужно HTTP-кешу
+        date_from = job.date_from or (datetime.now().astimezone().replace(second=0, microsecond=0)
+                                      - timedelta(days=job.period_days))
+        return date_from, job.date_to
+
+    def job_params(self, job):
+        if isinstance(job.area, int):
+            area_id, city = job.area, str(job.area)
         else:
-            return "Не указана"
+            area_id, city = self.get_city_id(job.area), job.area
+        date_from, date_to = self.job_window(job)
+        params = {
+            "area": area_id,
+            "date_from": date_from.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "order_by": "publication_time"
+        }
+        if date_to is not None:
+            params["date_to"] = date_to.strftime("%Y-%m-%dT%H:%M:%S%z")
+        if job.text:
+            params["text"] = job.text
+        params.update(job.params)
+        label = " / ".join(str(part) for part in (city, job.text) if part)
+        if job.params:
+            label += " " + ",".join(f"{key}={value}" for key, value in job.params)
+        return params, city, label
+
+    def count(self, job):
+        params, _, _ = self.job_params(job)
+        params.update({"per_page": 1, "page": 0})
+        response = self._get(self.base_url, params=params, timeout=20)
+        response.raise_for_status()
+        return response.json().get("found", 0)
+
+    def professional_roles(self):
+        if self._roles is None:
+            url = self.base_url.rsplit("/vacancies", 1)[0] + "/professional_roles"
+            response = self._get(url, timeout=20, max_age=86400)
+            response.raise_for_status()
+            self._roles = sorted({role["id"] for category in response.json().get("categories", [])
+                                  for role in category.get("roles", [])}, key=int)
+        return self._roles
+
+    def currency_rates(self):
+        # Справочник HH: rate - сколько единиц валюты дают за рубль. HTTP-кеш держит его сутки
+        url = self.base_url.rsplit("/vacancies", 1)[0] + "/dictionaries"
+        response = self._get(url, timeout=20, max_age=86400)
+        response.raise_for_status()
+        return {currency["code"]: currency["rate"] for currency in response.json().get("currency", [])
+                if currency.get("rate")}
+
+    def fetch_vacancy_details(self, vacancy_id, snippet_length=500):
+        response = self._get(f"{self.base_url}/{vacancy_id}", timeout=20)
+        response.raise_for_status()
+        data = response.json()
+        description = html.unescape(re.sub(r"<[^>]+>", " ", data.get("description") or ""))
+        description = " ".join(description.split())
+        if len(description) > snippet_length:
+            description = description[:snippet_length].rsplit(" ", 1)[0] + "…"
+        return {
+            "id": str(vacancy_id),
+            "key_skills": [skill.get("name") for skill in data.get("key_skills") or [] if skill.get("name")],
+            "schedule": (data.get("schedule") or {}).get("name"),
+            "employment": (data.get("employment") or {}).get("name"),
+            "experience": (data.get("experience") or {}).get("name"),
+            "description": description,
+        }
 
-    def fetch_vacancies(self, city="Пермь", keywords=None, period_days=30):
-        city_id = self.get_city_id(city)
-        date_from = (datetime.now() - timedelta(days=period_days)).strftime("%Y-%m-%dT%H:%M:%S")
-        vacancies = []
+    def iter_job_pages(self, job, max_pages=None, known_ids=None):
+        base_params, city, label = self.job_params(job)
+        log(logging.INFO, "Поиск вакансий в {label} с {date_from}...", label=label,
+            date_from=base_params['date_from'])
+        # hh.ru не отдаёт глубже MAX_DEPTH результатов; всё, что не влезло, нарезает CrawlPlanner
+        depth_pages = self.MAX_DEPTH // self.PER_PAGE
+        max_pages = min(max_pages or depth_pages, depth_pages)
         page = 0
-        print(f"Поиск вакансий в {city} за последние {period_days} дней...")
 
+        while True:
+            params = dict(base_params, per_page=self.PER_PAGE, page=page)
+            log(logging.DEBUG, "  [{label}] Запрос к HH: {url} {params}", label=label, url=self.base_url,
+                params=params)
+            with METRICS.timer("http_fetch"):
+                response = self._get(self.base_url, params=params, timeout=20)
+            METRICS.inc("hh_requests_total", status=response.status_code)
+            response.raise_for_status()
+            with METRICS.timer("json_parse"):
+                data = response.json()
+                items = data.get("items", [])
+                page_vacancies = [self._parse_item(item, city) for item in items if item.get("name")]
+            if not items:
+                break
+
+            METRICS.inc("hh_vacancies_total", len(page_vacancies))
+            log(logging.INFO, "  [{label}] Страница {page}: найдено {count} вакансий",
+                label=label, page=page + 1, count=len(items))
+            # Выдача отсортирована по дате: если вся страница уже в БД, дальше только старое.
+            # Проверяем до yield — иначе писатель может успеть сохранить страницу раньше проверки
+            all_known = False
+            if known_ids is not None and page_vacancies:
+                ids = [v["id"] for v in page_vacancies]
+                all_known = len(known_ids(ids)) == len(ids)
+            yield page_vacancies
+            if all_known:
+                log(logging.INFO, "  [{label}] Все вакансии страницы уже известны, останавливаюсь", label=label)
+                break
+            pages = data.get("pages", 0)
+            if page == 0 and data.get("found", 0) > self.MAX_DEPTH:
+                log(logging.WARNING, "  [{label}] Найдено {found} > {max_depth}: часть выдачи недоступна",
+                    label=label, found=data['found'], max_depth=self.MAX_DEPTH)
+            page += 1
+            if page >= pages or page >= max_pages:
+                break
+
+    def iter_vacancies(self, city="Пермь", keywords=None, period_days=30, max_pages=None):
+        try:
+            for page_vacancies in self.iter_job_pages(FetchJob(city, keywords, period_days), max_pages):
+                yield from page_vacancies
+        except Exception as e:
+            log(logging.ERROR, "  Ошибка при парсинге HH.ru: {error}", error=e)
+
+    def _run_job(self, job, max_pages, known_ids, out, stop):
+        def put(entry):
+            while not stop.is_set():
+                try:
+                    out.put(entry, timeout=0.5)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        try:
+            for page_vacancies in self.iter_job_pages(job, max_pages, known_ids):
+                if not put((job, page_vacancies)):
+                    return
+            put((job, None))
+        except Exception as e:
+            log(logging.ERROR, "  Ошибка задачи {job}: {error}", job=job, error=e)
+
+    def iter_pages(self, jobs, max_pages=None, known_ids=None, buffer_pages=16):
+        # Выдаёт (задача, страница вакансий) по мере прихода; (задача, None) - задача выгружена
+        # полностью. Очередь ограничена, так что память не растёт с глубиной выдачи,
+        # а потребитель пишет в БД, пока следующие страницы ещё в пути.
+        # Страницы одного запроса идут последовательно, разные запросы - параллельно.
+        jobs = list(jobs)
+        if not jobs:
+            return
+        out = queue.Queue(maxsize=buffer_pages)
+        stop = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=min(self.max_workers, len(jobs)))
+        futures = [pool.submit(self._run_job, job, max_pages, known_ids, out, stop) for job in jobs]
         try:
             while True:
-                params = {
-                    "area": city_id,
-                    "per_page": 50,
-                    "page": page,
-                    "date_from": date_from,
-                    "order_by": "publication_time"
-                }
-
-                print(f"  Запрос к HH: {self.base_url}")
-                print(f"  Параметры: {params}")
-                response = self.session.get(self.base_url, params=params, timeout=20)
-                print(f"  Статус ответа: {response.status_code}")
-                print(f"  Тело ответа (первые 300): {response.text[:300]}")
-
-                response.raise_for_status()
-                data = response.json()
+                try:
+                    entry = out.get(timeout=0.5)
+                except queue.Empty:
+                    # Задача завершается только после своей последней записи в очередь
+                    if all(future.done() for future in futures) and out.empty():
+                        break
+                    continue
+                yield entry
+        finally:
+            stop.set()
+            pool.shutdown(wait=True)
+
+    def fetch_jobs(self, jobs, max_pages=None, known_ids=None):
+        results = {}
+        for job, page_vacancies in self.iter_pages(jobs, max_pages=max_pages, known_ids=known_ids):
+            vacancies = results.setdefault(job, [])
+            if page_vacancies:
+                vacancies.extend(page_vacancies)
+        return results
+
+    def fetch_many(self, jobs, max_pages=None, known_ids=None):
+        jobs = list(jobs)
+        results = self.fetch_jobs(jobs, max_pages=max_pages, known_ids=known_ids)
+        merged = {}
+        for job in jobs:
+            for vacancy in results.get(job, []):
+                merged.setdefault(vacancy["id"], vacancy)
+        log(logging.INFO, "Всего уникальных вакансий по {jobs} запросам: {count}", jobs=len(jobs), count=len(merged))
+        return list(merged.values())
 
-                items = data.get("items", [])
-                if not items:
+    def fetch_vacancies(self, city="Пермь", keywords=None, period_days=30):
+        return list(self.iter_vacancies(city, keywords, period_days))
+
+
+def job_key(job):
+    return str(job.area), job.text or ""
+
+
+class CrawlPlanner:
+    # hh.ru отдаёт не больше HHruParser.MAX_DEPTH результатов на запрос. Планировщик делит запрос
+    # пополам по окну дат, пока каждый кусок не влезет; окно короче min_window делится по
+    # professional_role. Дерево нарезки кешируется в БД и переиспользуется ttl_hours.
+    def __init__(self, parser, db, min_window_minutes=30, ttl_hours=24):
+        self.parser = parser
+        self.db = db
+        self.min_window = timedelta(minutes=min_window_minutes)
+        self.ttl = timedelta(hours=ttl_hours)
+
+    def _split(self, job, date_from, date_to):
+        job = job._replace(date_from=date_from, date_to=date_to)
+        found = self.parser.count(job)
+        if found <= self.parser.MAX_DEPTH:
+            return [job]
+        if date_to - date_from > self.min_window:
+            middle = date_from + (date_to - date_from) / 2
+            return self._split(job, date_from, middle) + self._split(job, middle, date_to)
+        if "professional_role" in dict(job.params):
+            log(logging.WARNING, "  Окно {date_from:%d.%m %H:%M}-{date_to:%H:%M}: {found} вакансий одной профроли, "
+                "часть выдачи недоступна", date_from=date_from, date_to=date_to, found=found)
+            return [job]
+        log(logging.INFO, "  Окно {date_from:%d.%m %H:%M}-{date_to:%H:%M}: {found} вакансий, делю по профролям",
+            date_from=date_from, date_to=date_to, found=found)
+        return [job._replace(params=job.params + (("professional_role", role),))
+                for role in self.parser.professional_roles()]
+
+    def _from_cache(self, job, leaves, date_from, date_to):
+        start = int(date_from.timestamp())
+        if not leaves or start < min(leaf["from"] for leaf in leaves):
+            return None
+        end = int(date_to.timestamp()) if date_to is not None else None
+        tz = date_from.tzinfo
+        jobs = []
+        for leaf in leaves:
+            leaf_from = max(leaf["from"], start)
+            leaf_to = leaf["to"]
+            if end is not None:
+                leaf_to = end if leaf_to is None else min(leaf_to, end)
+            if leaf_to is not None and leaf_to <= leaf_from:
+                continue
+            params = job.params + ((("professional_role", leaf["role"]),) if leaf["role"] else ())
+            jobs.append(job._replace(
+                date_from=datetime.fromtimestamp(leaf_from, tz),
+                date_to=datetime.fromtimestamp(leaf_to, tz) if leaf_to is not None else None,
+                params=params))
+        return jobs
+
+    def plan(self, job):
+        date_from, date_to = self.parser.job_window(job)
+        cached = self.db.get_crawl_plan(*job_key(job), max_age=self.ttl)
+        if cached is not None:
+            jobs = self._from_cache(job, cached, date_from, date_to)
+            if jobs is not None:
+                return self._refresh_open(job, jobs, cached)
+        upper = date_to or datetime.now(date_from.tzinfo)
+        leaves = self._split(job, date_from, upper)
+        if date_to is None:
+            # Самый свежий кусок остаётся открытым, чтобы в него попадали новые вакансии
+            leaves = [leaf._replace(date_to=None) if leaf.date_to == upper else leaf for leaf in leaves]
+        if len(leaves) > 1:
+            log(logging.INFO, "Запрос {query} разбит на {parts} частей",
+                query=" / ".join(filter(None, job_key(job))), parts=len(leaves))
+        self.db.save_crawl_plan(*job_key(job), [{
+            "from": int(leaf.date_from.timestamp()),
+            "to": int(leaf.date_to.timestamp()) if leaf.date_to is not None else None,
+            "role": dict(leaf.params).get("professional_role"),
+        } for leaf in leaves])
+        return leaves
+
+    def _refresh_open(self, job, jobs, cached):
+        # Открытый (самый свежий) кусок растёт, пока план лежит в кеше: его пересчитываем каждый раз
+        # и, если он перерос MAX_DEPTH, нарезаем заново - остальной план не трогаем
+        for index, leaf in enumerate(jobs):
+            if leaf.date_to is not None or "professional_role" in dict(leaf.params):
+                continue
+            if self.parser.count(leaf) <= self.parser.MAX_DEPTH:
+                continue
+            upper = datetime.now(leaf.date_from.tzinfo)
+            split = self._split(leaf, leaf.date_from, upper)
+            split = [part._replace(date_to=None) if part.date_to == upper else part for part in split]
+            log(logging.INFO, "Свежий кусок запроса {query} перерос {max_depth}, разбит на {parts} частей",
+                query=" / ".join(filter(None, job_key(job))), max_depth=self.parser.MAX_DEPTH, parts=len(split))
+            jobs = jobs[:index] + split + jobs[index + 1:]
+            self.db.save_crawl_plan(*job_key(job), [item for item in cached
+                                                    if item["to"] is not None or item["role"]] + [{
+                "from": int(part.date_from.timestamp()),
+                "to": int(part.date_to.timestamp()) if part.date_to is not None else None,
+                "role": dict(part.params).get("professional_role"),
+            } for part in split])
+            break
+        return jobs
+
+    def plan_many(self, jobs):
+        jobs = list(jobs)
+        if not jobs:
+            return []
+        planned = []
+        with ThreadPoolExecutor(max_workers=min(self.parser.max_workers, len(jobs))) as pool:
+            for job, leaves in zip(jobs, pool.map(self._plan_safe, jobs)):
+                planned.extend(leaves)
+        return planned
+
+    def _plan_safe(self, job):
+        try:
+            return self.plan(job)
+        except Exception as e:
+            log(logging.ERROR, "  Не удалось спланировать {query}: {error}",
+                query=" / ".join(filter(None, job_key(job))), error=e)
+            return [job]
+
+
+class IncrementalFetcher:
+    def __init__(self, parser, db, overlap_minutes=30, planner=None):
+        self.parser = parser
+        self.db = db
+        self.overlap = timedelta(minutes=overlap_minutes)
+        self.planner = planner or CrawlPlanner(parser, db)
+        self.pending_cursors = {}
+
+    cursor_key = staticmethod(job_key)
+
+    def plan(self, jobs):
+        planned = []
+        for job in jobs:
+            cursor = self.db.get_fetch_cursor(*self.cursor_key(job))
+            since = parse_published_at(cursor)
+            if since is not None:
+                oldest = datetime.now(since.tzinfo) - timedelta(days=job.period_days)
+                job = job._replace(date_from=max(since - self.overlap, oldest))
+            planned.append(job)
+        return self.planner.plan_many(planned)
+
+    def iter_pages(self, jobs, max_pages=None):
+        self.pending_cursors = {}
+        newest = {}
+        planned = self.plan(jobs)
+        remaining = {}
+        for job in planned:
+            key = self.cursor_key(job)
+            remaining[key] = remaining.get(key, 0) + 1
+        for job, page_vacancies in self.parser.iter_pages(planned, max_pages=max_pages,
+                                                          known_ids=self.db.existing_ids):
+            key = self.cursor_key(job)
+            if page_vacancies is None:
+                # Курсор двигаем, только когда все части запроса выгружены без ошибок
+                remaining[key] -= 1
+                if remaining[key] == 0 and key in newest:
+                    self.pending_cursors[key] = newest[key]
+                continue
+            for vacancy in page_vacancies:
+                published = parse_published_at(vacancy["published_at"])
+                if published is not None and (key not in newest or published > newest[key][0]):
+                    newest[key] = (published, vacancy["published_at"])
+            yield page_vacancies
+
+    def fetch(self, jobs, max_pages=None):
+        merged = {}
+        for page_vacancies in self.iter_pages(jobs, max_pages=max_pages):
+            for vacancy in page_vacancies:
+                merged.setdefault(vacancy["id"], vacancy)
+        log(logging.INFO, "Всего уникальных вакансий: {count}", count=len(merged))
+        return list(merged.values())
+
+    def commit(self):
+        # Курсоры двигаем только после сохранения вакансий, иначе падение между
+        # загрузкой и записью потеряет окно
+        for (area, query), (published, published_at) in self.pending_cursors.items():
+            self.db.update_fetch_cursor(area, query, published_at, int(published.timestamp()))
+        self.pending_cursors = {}
+
+
+class VacancyEnricher:
+    # Детали (/vacancies/{id}) грузятся для вакансий, у которых их ещё нет, - свежие первыми и не
+    # больше limit за цикл. Неудачная загрузка (403/429, таймаут, выход посреди цикла) повторится
+    # в следующем цикле; стоимость цикла ограничена limit, а не размером базы
+    def __init__(self, parser, db, max_workers=4, limit=500):
+        self.parser = parser
+        self.db = db
+        self.max_workers = max_workers
+        self.limit = limit
+
+    def _fetch(self, vacancy_id):
+        try:
+            return self.parser.fetch_vacancy_details(vacancy_id)
+        except Exception as e:
+            if getattr(getattr(e, "response", None), "status_code", None) in (404, 410):
+                # Вакансию сняли с HH - деталей уже не будет, пустая запись прекращает повторы
+                return {"id": str(vacancy_id), "key_skills": [], "schedule": None, "employment": None,
+                        "experience": None, "description": None}
+            log(logging.WARNING, "  Не удалось получить детали вакансии {vacancy_id}: {error}",
+                vacancy_id=vacancy_id, error=e)
+            return None
+
+    def enrich(self, vacancy_ids=None, exit_controller=None):
+        if vacancy_ids is None:
+            vacancy_ids = self.db.unenriched_ids(self.limit)
+        vacancy_ids = list(dict.fromkeys(vacancy_ids))
+        if not vacancy_ids:
+            return 0
+        known = self.db.enriched_ids(vacancy_ids)
+        pending = [vacancy_id for vacancy_id in vacancy_ids if vacancy_id not in known]
+        enriched = 0
+        with ThreadPoolExecutor(max_workers=min(self.max_workers, max(len(pending), 1))) as pool:
+            # Пачками, чтобы сохранять результат по ходу и вовремя заметить запрос на выход
+            for i in range(0, len(pending), 50):
+                if exit_controller is not None and exit_controller.exit_now:
                     break
+                details = [d for d in pool.map(self._fetch, pending[i:i + 50]) if d is not None]
+                self.db.save_vacancy_details(details)
+                enriched += len(details)
+        log(logging.INFO, "Получены детали для {count} вакансий", count=enriched)
+        return enriched
+
+
+class VacancyBatchWriter:
+    # По умолчанию пачка - одна страница выдачи: вставка идёт сразу после первого ответа HH
+    def __init__(self, db, batch_size=HHruParser.PER_PAGE):
+        self.db = db
+        self.batch_size = batch_size
+        self.buffer = []
+        self.inserted = []
+
+    def add(self, vacancies):
+        self.buffer.extend(vacancies)
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            batch, self.buffer = self.buffer, []
+            self.inserted.extend(self.db.save_vacancies(batch))
+        return self.inserted
+
+
+class SQLiteConnectionManager:
+    def __init__(self, db_file, cache_size_kb=16384, mmap_size=64 * 1024 * 1024,
+                 busy_timeout_ms=5000, cached_statements=256):
+        self.db_file = db_file
+        self.cache_size_kb = cache_size_kb
+        self.mmap_size = mmap_size
+        self.busy_timeout_ms = busy_timeout_ms
+        self.cached_statements = cached_statements
+        self._local = threading.local()
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # check_same_thread=False только чтобы закрыть соединение умершего потока;
+        # пользуется соединением всегда один поток - его владелец
+        conn = sqlite3.connect(self.db_file, timeout=self.busy_timeout_ms / 1000,
+                               cached_statements=self.cached_statements,
+                               check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        conn.execute(f"PRAGMA mmap_size={int(self.mmap_size)}")
+        conn.execute(f"PRAGMA busy_timeout={int(self.busy_timeout_ms)}")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    def _prune_dead(self):
+        alive = {thread.ident for thread in threading.enumerate()}
+        for ident in [ident for ident in self._connections if ident not in alive]:
+            try:
+                self._connections.pop(ident).close()
+            except sqlite3.Error:
+                pass
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._open()
+            self._local.conn = conn
+            with self._lock:
+                self._prune_dead()
+                self._connections[threading.get_ident()] = conn
+        return conn
+
+    def close_all(self):
+        with self._lock:
+            for conn in self._connections.values():
+                try:
+                    conn.close()
+                except sqlite3.Error:
+                    pass
+            self._connections.clear()
+        self._local = threading.local()
+
+
+class CachedResponse:
+    from_cache = True
+    status_code = 200
+
+    def __init__(self, url, content):
+        self.url = url
+        self.content = content
+
+    @property
+    def text(self):
+        return self.content.decode("utf-8")
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        pass
+
+
+class HTTPCache:
+    # Дисковый кеш GET-ответов в отдельном SQLite-файле. Записи с ETag/Last-Modified
+    # перепроверяются условным запросом (304 - тело берём из кеша); max_age позволяет
+    # отдавать свежую запись вообще без запроса. Вытеснение - по TTL и LRU до max_bytes.
+    EVICT_BATCH = 16
+
+    def __init__(self, path="http_cache.db", max_bytes=64 * 1024 * 1024, ttl_seconds=7 * 86400):
+        self.max_bytes = max_bytes
+        self.ttl_seconds = ttl_seconds
+        self.connections = SQLiteConnectionManager(path, cache_size_kb=2048)
+        self.hits = 0
+        self.misses = 0
+        self.not_modified = 0
+        self._stats_lock = threading.Lock()
+        with self._connection() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS http_cache (
+                    key TEXT PRIMARY KEY,
+                    etag TEXT,
+                    last_modified TEXT,
+                    body BLOB NOT NULL,
+                    size INTEGER NOT NULL,
+                    stored_at REAL NOT NULL,
+                    accessed_at REAL NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_http_cache_accessed ON http_cache(accessed_at)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_http_cache_stored ON http_cache(stored_at)")
+            # Суммарный размер тел ведут триггеры: запись в кеш не пересчитывает SUM по всей таблице,
+            # и счётчик верен, даже если файл кеша делят несколько процессов
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS http_cache_size (
+                    id INTEGER PRIMARY KEY CHECK (id = 1),
+                    total INTEGER NOT NULL
+                )
+            """)
+            conn.execute("""
+                INSERT OR IGNORE INTO http_cache_size (id, total)
+                SELECT 1, COALESCE(SUM(size), 0) FROM http_cache
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS http_cache_size_insert AFTER INSERT ON http_cache BEGIN
+                    UPDATE http_cache_size SET total = total + new.size WHERE id = 1;
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS http_cache_size_update AFTER UPDATE OF size ON http_cache BEGIN
+                    UPDATE http_cache_size SET total = total + new.size - old.size WHERE id = 1;
+                END
+            """)
+            conn.execute("""
+                CREATE TRIGGER IF NOT EXISTS http_cache_size_delete AFTER DELETE ON http_cache BEGIN
+                    UPDATE http_cache_size SET total = total - old.size WHERE id = 1;
+                END
+            """)
+            conn.commit()
 
-                for item in items:
-                    if not item.get("name"):
-                        continue
-                    vacancy = {
-                        "id": str(item["id"]),
-                        "title": item.get("name", "").strip(),
-                        "company": item.get("employer", {}).get("name", "").strip(),
-                        "salary": self.format_salary(item.get("salary")),
-                        "url": item.get("alternate_url", f"https://hh.ru/vacancy/{item['id']}"),
-                        "published_at": item.get("published_at", ""),
-                        "source": "hh.ru",
-                        "city": item.get("area", {}).get("name", city)
-                    }
-                    vacancies.append(vacancy)
-
-                print(f"  Страница {page + 1}: найдено {len(items)} вакансий")
-                pages = data.get("pages", 0)
-                page += 1
-                if page >= pages or page >= 5:
-                    break
-                time.sleep(0.5)
+    @contextmanager
+    def _connection(self):
+        conn = self.connections.connection()
+        try:
+            yield conn
+        finally:
+            if conn.in_transaction:
+                conn.rollback()
+
+    def _count(self, counter):
+        with self._stats_lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def stats(self):
+        with self._stats_lock:
+            return {"hits": self.hits, "misses": self.misses, "not_modified": self.not_modified}
+
+    @staticmethod
+    def cache_key(url, params=None):
+        import requests
+
+        return requests.Request("GET", url, params=params).prepare().url
+
+    def get(self, session, url, params=None, timeout=20, max_age=0):
+        key = self.cache_key(url, params)
+        now = time.time()
+        with self._connection() as conn:
+            entry = conn.execute("SELECT etag, last_modified, body, stored_at FROM http_cache WHERE key = ?",
+                                 (key,)).fetchone()
+        if entry is not None and now - entry["stored_at"] > self.ttl_seconds:
+            entry = None
+        if entry is not None and now - entry["stored_at"] < max_age:
+            self._count("hits")
+            self._touch(key, now)
+            return CachedResponse(key, entry["body"])
+
+        headers = {}
+        if entry is not None:
+            if entry["etag"]:
+                headers["If-None-Match"] = entry["etag"]
+            if entry["last_modified"]:
+                headers["If-Modified-Since"] = entry["last_modified"]
+        response = session.get(url, params=params, timeout=timeout, headers=headers)
+        if response.status_code == 304 and entry is not None:
+            self._count("not_modified")
+            self._touch(key, now, refresh=True)
+            return CachedResponse(key, entry["body"])
+        self._count("misses")
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status_code == 200 and (etag or last_modified or max_age):
+            self._store(key, etag, last_modified, response.content, now)
+        return response
+
+    def _touch(self, key, now, refresh=False):
+        with self._connection() as conn:
+            if refresh:
+                conn.execute("UPDATE http_cache SET accessed_at = ?, stored_at = ? WHERE key = ?", (now, now, key))
+            else:
+                conn.execute("UPDATE http_cache SET accessed_at = ? WHERE key = ?", (now, key))
+            conn.commit()
 
-        except Exception as e:
-            print(f"  Ошибка при парсинге HH.ru: {e}")
+    def _store(self, key, etag, last_modified, body, now):
+        with self._connection() as conn:
+            conn.execute("""
+                INSERT INTO http_cache (key, etag, last_modified, body, size, stored_at, accessed_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (key) DO UPDATE SET etag = excluded.etag, last_modified = excluded.last_modified,
+                    body = excluded.body, size = excluded.size, stored_at = excluded.stored_at,
+                    accessed_at = excluded.accessed_at
+            """, (key, etag, last_modified, body, len(body), now, now))
+            conn.execute("DELETE FROM http_cache WHERE stored_at < ?", (now - self.ttl_seconds,))
+            # LRU: давно не читанные записи удаляются небольшими пачками, пока не влезем в лимит
+            while conn.execute("SELECT total FROM http_cache_size WHERE id = 1").fetchone()[0] > self.max_bytes:
+                deleted = conn.execute("""
+                    DELETE FROM http_cache WHERE key IN (
+                        SELECT key FROM http_cache ORDER BY accessed_at LIMIT ?
+                    )
+                """, (self.EVICT_BATCH,)).rowcount
+                if not deleted:
+                    break
+            conn.commit()
 
-        print(f"Всего найдено {len(vacancies)} вакансий в {city}")
-        return vacancies
+    def close(self):
+        self.connections.close_all()
+
+
+Fingerprint = namedtuple("Fingerprint", ["exact", "simhash", "bands"])
+
+
+class DuplicateDetector:
+    # Перепосты одной вакансии под новым id. Точный отпечаток - хеш нормализованных названия,
+    # компании, зарплаты и города; почти-дубли ищутся по 64-битному SimHash названия и компании.
+    # SimHash режется на 4 полосы по 16 бит: при расстоянии Хэмминга <= 3 хотя бы одна полоса
+    # совпадает целиком (принцип Дирихле), поэтому кандидаты достаются индексом, без попарных
+    # сравнений. Ключ полосы включает город и зарплату - они обязаны совпадать точно.
+    # Перепостом считается только совпадение в пределах REPOST_WINDOW_DAYS по дате публикации:
+    # та же вакансия сети через полгода - новый набор, а не перепост.
+    BANDS = 4
+    MAX_DISTANCE = 3
+    MAX_CANDIDATES = 200
+    REPOST_WINDOW_DAYS = 14
+    # Предлоги, союзы и "г." из "г. Пермь". Короткие слова вроде "C", "1С", "ПК" значимы и остаются
+    STOP_WORDS = frozenset("в во на по с со к ко и а или от до для из за о об у при г".split())
+    _punctuation = re.compile(r"[^\w]+")
+
+    @classmethod
+    def normalize(cls, text):
+        return " ".join(cls._punctuation.sub(" ", str(text or "").lower().replace("ё", "е")).split())
+
+    @staticmethod
+    def _hash64(text):
+        return int.from_bytes(hashlib.blake2b(text.encode(), digest_size=8).digest(), "big")
+
+    @staticmethod
+    def _signed(value):
+        # SQLite хранит INTEGER как знаковое 64-битное
+        return value - (1 << 64) if value >= 1 << 63 else value
+
+    @classmethod
+    def simhash(cls, tokens):
+        weights = [0] * 64
+        for token in tokens:
+            value = cls._hash64(token)
+            for bit in range(64):
+                weights[bit] += 1 if value >> bit & 1 else -1
+        return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+    @classmethod
+    def fingerprint(cls, vacancy):
+        title = cls.normalize(vacancy.get('title'))
+        company = cls.normalize(vacancy.get('company'))
+        scope = f"{cls.normalize(vacancy.get('salary'))}|{cls.normalize(vacancy.get('city'))}"
+        exact = hashlib.blake2b(f"{title}|{company}|{scope}".encode(), digest_size=16).hexdigest()
+        # Множество значимых слов названия (без предлогов и названия города) плюс компания целиком:
+        # порядок слов, скобки и "г. Пермь" в заголовке перепоста на отпечаток не влияют
+        city_words = set(cls.normalize(vacancy.get('city')).split())
+        tokens = {word for word in title.split() if word not in cls.STOP_WORDS and word not in city_words}
+        tokens.add(f"@{company}")
+        simhash = cls.simhash(sorted(tokens))
+        bands = tuple(cls._signed(cls._hash64(f"{scope}|{band}|{simhash >> (16 * band) & 0xFFFF}"))
+                      for band in range(cls.BANDS))
+        return Fingerprint(exact, simhash, bands)
+
+    def find(self, cursor, fp, published_ts):
+        if not published_ts:
+            return None
+        window = self.REPOST_WINDOW_DAYS * 86400
+        low, high = published_ts - window, published_ts + window
+        cursor.execute("""
+            SELECT id FROM vacancy_fingerprints
+            WHERE fingerprint = ? AND published_ts BETWEEN ? AND ?
+            LIMIT 1
+        """, (fp.exact, low, high))
+        row = cursor.fetchone()
+        if row is not None:
+            return row[0]
+        cursor.execute("""
+            SELECT id, simhash FROM vacancy_fingerprints
+            WHERE (band0 = ? OR band1 = ? OR band2 = ? OR band3 = ?) AND published_ts BETWEEN ? AND ?
+            LIMIT ?
+        """, fp.bands + (low, high, self.MAX_CANDIDATES))
+        for candidate_id, candidate_hash in cursor.fetchall():
+            if ((candidate_hash & 0xFFFFFFFFFFFFFFFF) ^ fp.simhash).bit_count() <= self.MAX_DISTANCE:
+                return candidate_id
+        return None
+
+    def remember(self, cursor, vacancy_id, fp, published_ts):
+        cursor.execute("""
+            INSERT OR IGNORE INTO vacancy_fingerprints
+            (id, fingerprint, simhash, band0, band1, band2, band3, published_ts)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+        """, (vacancy_id, fp.exact, self._signed(fp.simhash)) + fp.bands + (published_ts,))
+
+
+# Правило канала: пустые cities/keywords - без ограничений; salary_min - нижняя граница в рублях
+ChannelRule = namedtuple("ChannelRule", ["channel", "cities", "salary_min", "keywords"],
+                         defaults=((), None, ()))
+
+
+def load_channel_rules(path, default_channel):
+    # JSON-список объектов {"channel", "cities", "salary_min", "keywords"}; без файла - один канал
+    if not path:
+        return [ChannelRule(default_channel)]
+    with open(path, encoding="utf-8") as f:
+        config = json.load(f)
+    return [ChannelRule(entry["channel"], tuple(entry.get("cities") or ()), entry.get("salary_min"),
+                        tuple(entry.get("keywords") or ())) for entry in config]
+
+
+class ChannelRouter:
+    # Правила не перебираются для каждой вакансии: город и первые слова ключевых фраз разложены
+    # по словарям, так что на вакансию - пара обращений к словарю и проверка зарплаты у кандидатов
+    def __init__(self, rules):
+        self.rules = list(rules)
+        self.channels = [rule.channel for rule in self.rules]
+        self._by_city = {}
+        self._any_city = set()
+        self._by_word = {}
+        self._any_keyword = set()
+        for index, rule in enumerate(self.rules):
+            if rule.cities:
+                for city in rule.cities:
+                    self._by_city.setdefault(DuplicateDetector.normalize(city), set()).add(index)
+            else:
+                self._any_city.add(index)
+            if rule.keywords:
+                for keyword in rule.keywords:
+                    phrase = DuplicateDetector.normalize(keyword)
+                    if phrase:
+                        self._by_word.setdefault(phrase.split()[0], []).append((index, f" {phrase} "))
+            else:
+                self._any_keyword.add(index)
+
+    @staticmethod
+    def salary_rub(vacancy):
+        # Вилка в рублях по курсу (VacancyDatabase.normalize_salary); без неё - рублёвая вилка как есть
+        values = [value for value in (vacancy.get('salary_from_rub'), vacancy.get('salary_to_rub')) if value]
+        if not values and (vacancy.get('salary_currency') or 'RUR').upper() in ('RUR', 'RUB'):
+            values = [value for value in (vacancy.get('salary_from'), vacancy.get('salary_to')) if value]
+        return max(values) if values else None
+
+    def route(self, vacancy):
+        candidates = self._any_city | self._by_city.get(DuplicateDetector.normalize(vacancy.get('city')), set())
+        if not candidates:
+            return []
+        matched = candidates & self._any_keyword
+        if len(matched) < len(candidates):
+            title = DuplicateDetector.normalize(vacancy.get('title'))
+            padded = f" {title} "
+            for word in set(title.split()):
+                for index, phrase in self._by_word.get(word, ()):
+                    if index in candidates and phrase in padded:
+                        matched.add(index)
+        channels = []
+        salary = None
+        for index in sorted(matched):
+            rule = self.rules[index]
+            if rule.salary_min:
+                if salary is None:
+                    salary = self.salary_rub(vacancy) or 0
+                if salary < rule.salary_min:
+                    continue
+            channels.append(rule.channel)
+        return channels
+
+
+class VacancyArchive:
+    # Архив вакансий, вытесненных из рабочей БД: раздел на каждый день публикации
+    # (archive/2024/05/2024-05-17/part-*.jsonl.gz). Внутри файла хранение по столбцам:
+    # первая строка - заголовок со списком столбцов, дальше по строке JSON-массива на столбец.
+    def __init__(self, directory="archive"):
+        self.directory = directory
+
+    def _partition_dir(self, day):
+        return os.path.join(self.directory, day[:4], day[5:7], day)
+
+    def write(self, rows):
+        by_day = {}
+        for row in rows:
+            day = datetime.fromtimestamp(row['published_ts']).strftime('%Y-%m-%d')
+            by_day.setdefault(day, []).append(row)
+        written = 0
+        for day, day_rows in sorted(by_day.items()):
+            written += self._write_part(day, day_rows)
+        return written
+
+    def _write_part(self, day, rows):
+        columns = list(rows[0].keys())
+        ids = sorted(str(row['id']) for row in rows)
+        # Имя части зависит только от набора id: если процесс упал между записью архива и удалением
+        # из БД, повторный прогон перезапишет ту же часть, а не продублирует строки
+        name = f"part-{hashlib.md5(','.join(ids).encode()).hexdigest()[:16]}.jsonl.gz"
+        directory = self._partition_dir(day)
+        os.makedirs(directory, exist_ok=True)
+        path = os.path.join(directory, name)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as raw:
+            with gzip.GzipFile(fileobj=raw, mode="wb", compresslevel=9, mtime=0) as f:
+                header = {"columns": columns, "rows": len(rows), "day": day}
+                f.write((json.dumps(header, ensure_ascii=False) + "\n").encode("utf-8"))
+                for column in columns:
+                    values = [row[column] for row in rows]
+                    f.write((json.dumps(values, ensure_ascii=False) + "\n").encode("utf-8"))
+            raw.flush()
+            os.fsync(raw.fileno())
+        os.replace(tmp_path, path)
+        return len(rows)
+
+    def partitions(self, date_from=None, date_to=None):
+        # Дни отбираются по именам каталогов, файлы за пределами диапазона не открываются
+        if not os.path.isdir(self.directory):
+            return []
+        days = []
+        for year in sorted(os.listdir(self.directory)):
+            year_dir = os.path.join(self.directory, year)
+            if not os.path.isdir(year_dir):
+                continue
+            for month in sorted(os.listdir(year_dir)):
+                month_dir = os.path.join(year_dir, month)
+                if not os.path.isdir(month_dir):
+                    continue
+                for day in sorted(os.listdir(month_dir)):
+                    if date_from and day < date_from:
+                        continue
+                    if date_to and day > date_to:
+                        continue
+                    days.append(day)
+        return days
+
+    def _read_part(self, path, columns=None):
+        with gzip.open(path, "rt", encoding="utf-8") as f:
+            header = json.loads(f.readline())
+            wanted = set(columns or header["columns"])
+            data = {}
+            for column in header["columns"]:
+                line = f.readline()
+                if column in wanted:
+                    data[column] = json.loads(line)
+        names = [column for column in header["columns"] if column in data]
+        for values in zip(*(data[column] for column in names)):
+            yield dict(zip(names, values))
+
+    def scan(self, date_from=None, date_to=None, columns=None, where=None):
+        # Потоковое чтение: в памяти одновременно только одна часть раздела.
+        # date_from/date_to - строки YYYY-MM-DD, where - функция-фильтр по строке
+        for day in self.partitions(date_from, date_to):
+            directory = self._partition_dir(day)
+            for name in sorted(os.listdir(directory)):
+                if not name.endswith(".jsonl.gz"):
+                    continue
+                for row in self._read_part(os.path.join(directory, name), columns):
+                    if where is None or where(row):
+                        yield row
 
 
 class VacancyDatabase:
-    def __init__(self, db_file="vacancies.db"):
+    def __init__(self, db_file="vacancies.db", router=None):
         self.db_file = db_file
+        self.router = router
+        self.connections = SQLiteConnectionManager(db_file)
+        self.duplicates = DuplicateDetector()
+        self.renderer = VacancyRenderer()
+        self.currency_rates = {'RUR': 1.0}
         self.init_database()
+        self._load_currency_rates()
 
     @contextmanager
     def get_connection(self):
-        conn = sqlite3.connect(self.db_file)
-        conn.row_factory = sqlite3.Row
+        # Соединение живёт столько же, сколько поток; незакрытая транзакция откатывается
+        conn = self.connections.connection()
         try:
             yield conn
         finally:
-            conn.close()
+            if conn.in_transaction:
+                conn.rollback()
+
+    def close(self):
+        self.connections.close_all()
+
+    SCHEMA_VERSION = 12
 
     def init_database(self):
+        # Миграции по PRAGMA user_version: каждая выполняется ровно один раз, в своей транзакции
+        with self.get_connection() as conn:
+            while True:
+                conn.execute("BEGIN IMMEDIATE")
+                version = conn.execute("PRAGMA user_version").fetchone()[0]
+                if version >= self.SCHEMA_VERSION:
+                    conn.rollback()
+                    break
+                try:
+                    getattr(self, f"_migrate_{version + 1}")(conn)
+                    conn.execute(f"PRAGMA user_version = {version + 1}")
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            if conn.execute("PRAGMA auto_vacuum").fetchone()[0] != 2:
+                # Разовый перевод в auto_vacuum=INCREMENTAL: режим включается только полным VACUUM,
+                # дальше место после очистки возвращается через incremental_vacuum
+                conn.execute("PRAGMA auto_vacuum = INCREMENTAL")
+                conn.execute("VACUUM")
+
+    def _migrate_1(self, conn):
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS vacancies (
+                id TEXT PRIMARY KEY,
+                title TEXT,
+                company TEXT,
+                salary TEXT,
+                url TEXT,
+                published_at TEXT,
+                source TEXT,
+                city TEXT,
+                posted_to_channel BOOLEAN DEFAULT 0,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        conn.execute("CREATE INDEX IF NOT EXISTS idx_posted ON vacancies(posted_to_channel)")
+        conn.execute("""
+            CREATE TABLE IF NOT EXISTS fetch_cursors (
+                area TEXT NOT NULL,
+                query TEXT NOT NULL DEFAULT '',
+                last_published_at TEXT,
+                last_published_ts INTEGER,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (area, query)
+            )
+        """)
+
+    def _migrate_2(self, conn):
+        # Время публикации в секундах epoch: по строке с "+0300" SQLite не умеет ни сравнивать,
+        # ни строить индекс по date(...)
+        conn.execute("ALTER TABLE vacancies ADD COLUMN published_ts INTEGER")
+        rows = conn.execute("SELECT id, published_at FROM vacancies").fetchall()
+        conn.executemany("UPDATE vacancies SET published_ts = ? WHERE id = ?",
+                         [(published_timestamp(row[1]), row[0]) for row in rows])
+        conn.execute("DROP INDEX IF EXISTS idx_posted")
+        conn.execute("""
+            CREATE INDEX idx_unposted_published ON vacancies(published_ts)
+            WHERE posted_to_channel = 0
+        """)
+        conn.execute("CREATE INDEX idx_published_ts ON vacancies(published_ts)")
+
+    def _migrate_3(self, conn):
+        conn.execute("""
+            CREATE TABLE crawl_plans (
+                area TEXT NOT NULL,
+                query TEXT NOT NULL DEFAULT '',
+                plan TEXT NOT NULL,
+                created_ts INTEGER NOT NULL,
+                PRIMARY KEY (area, query)
+            )
+        """)
+
+    def get_fetch_cursor(self, area, query=""):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT last_published_at FROM fetch_cursors WHERE area = ? AND query = ?",
+                           (area, query))
+            row = cursor.fetchone()
+            return row[0] if row else None
+
+    def update_fetch_cursor(self, area, query, published_at, published_ts):
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                CREATE TABLE IF NOT EXISTS vacancies (
-                    id TEXT PRIMARY KEY,
-                    title TEXT,
-                    company TEXT,
-                    salary TEXT,
-                    url TEXT,
-                    published_at TEXT,
-                    source TEXT,
-                    city TEXT,
-                    posted_to_channel BOOLEAN DEFAULT 0,
-                    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
-                )
-            """)
-            cursor.execute("CREATE INDEX IF NOT EXISTS idx_posted ON vacancies(posted_to_channel)")
+                INSERT INTO fetch_cursors (area, query, last_published_at, last_published_ts)
+                VALUES (?, ?, ?, ?)
+                ON CONFLICT (area, query) DO UPDATE SET
+                    last_published_at = excluded.last_published_at,
+                    last_published_ts = excluded.last_published_ts,
+                    updated_at = CURRENT_TIMESTAMP
+                WHERE excluded.last_published_ts > fetch_cursors.last_published_ts
+            """, (area, query, published_at, published_ts))
             conn.commit()
 
-    def cleanup_old_vacancies(self, days_to_keep=30):
+    def _migrate_4(self, conn):
+        conn.execute("""
+            CREATE TABLE vacancy_details (
+                id TEXT PRIMARY KEY,
+                key_skills TEXT,
+                schedule TEXT,
+                employment TEXT,
+                experience TEXT,
+                description TEXT,
+                fetched_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    def _migrate_5(self, conn):
+        # Отпечатки не удаляются вместе с вакансиями: перепост ловится и после очистки
+        conn.execute("""
+            CREATE TABLE vacancy_fingerprints (
+                id TEXT PRIMARY KEY,
+                fingerprint TEXT NOT NULL,
+                simhash INTEGER NOT NULL,
+                band0 INTEGER NOT NULL,
+                band1 INTEGER NOT NULL,
+                band2 INTEGER NOT NULL,
+                band3 INTEGER NOT NULL
+            )
+        """)
+        conn.execute("CREATE INDEX idx_fingerprint ON vacancy_fingerprints(fingerprint)")
+        for band in range(DuplicateDetector.BANDS):
+            conn.execute(f"CREATE INDEX idx_fingerprint_band{band} ON vacancy_fingerprints(band{band})")
+        conn.execute("""
+            CREATE TABLE vacancy_duplicates (
+                id TEXT PRIMARY KEY,
+                original_id TEXT NOT NULL,
+                created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        cursor = conn.cursor()
+        rows = conn.execute("SELECT id, title, company, salary, city FROM vacancies ORDER BY created_at").fetchall()
+        for row in rows:
+            fp = DuplicateDetector.fingerprint(dict(row))
+            cursor.execute("""
+                INSERT OR IGNORE INTO vacancy_fingerprints (id, fingerprint, simhash, band0, band1, band2, band3)
+                VALUES (?, ?, ?, ?, ?, ?, ?)
+            """, (row["id"], fp.exact, DuplicateDetector._signed(fp.simhash)) + fp.bands)
+
+    def _migrate_6(self, conn):
+        conn.execute("ALTER TABLE vacancies ADD COLUMN message_text TEXT")
+        rows = conn.execute("SELECT * FROM vacancies WHERE posted_to_channel = 0").fetchall()
+        conn.executemany("UPDATE vacancies SET message_text = ? WHERE id = ?",
+                         [(self.renderer.render(dict(row)), row["id"]) for row in rows])
+
+    def _migrate_7(self, conn):
+        # Очередь публикации по каналам; published_ts продублирован, чтобы очередь канала
+        # читалась частичным индексом без сортировки
+        conn.execute("""
+            CREATE TABLE channel_posts (
+                channel TEXT NOT NULL,
+                vacancy_id TEXT NOT NULL,
+                published_ts INTEGER,
+                posted INTEGER NOT NULL DEFAULT 0,
+                posted_at TIMESTAMP,
+                PRIMARY KEY (channel, vacancy_id)
+            ) WITHOUT ROWID
+        """)
+        conn.execute("""
+            CREATE INDEX idx_channel_queue ON channel_posts(channel, published_ts)
+            WHERE posted = 0
+        """)
+        conn.execute("CREATE INDEX idx_channel_posts_published ON channel_posts(published_ts)")
+        conn.execute("""
+            CREATE TABLE channels (
+                channel TEXT PRIMARY KEY,
+                rules TEXT NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+
+    def _migrate_8(self, conn):
+        # Аренда и повторы для очереди публикации. posted: 0 - в очереди, 1 - отправлено,
+        # 2 - снято после max_attempts неудачных попыток
+        conn.execute("ALTER TABLE channel_posts ADD COLUMN claimed_by TEXT")
+        conn.execute("ALTER TABLE channel_posts ADD COLUMN claimed_at INTEGER")
+        conn.execute("ALTER TABLE channel_posts ADD COLUMN attempts INTEGER NOT NULL DEFAULT 0")
+        conn.execute("ALTER TABLE channel_posts ADD COLUMN next_attempt_at INTEGER NOT NULL DEFAULT 0")
+        conn.execute("ALTER TABLE channel_posts ADD COLUMN message_id INTEGER")
+        conn.execute("ALTER TABLE channel_posts ADD COLUMN last_error TEXT")
+
+    def _migrate_9(self, conn):
+        # Числовая вилка: как пришла от HH и в рублях по курсу на момент сохранения
+        for column in ("salary_from INTEGER", "salary_to INTEGER", "salary_currency TEXT",
+                       "salary_from_rub INTEGER", "salary_to_rub INTEGER", "role TEXT"):
+            conn.execute(f"ALTER TABLE vacancies ADD COLUMN {column}")
+        # Вакансии в валюте, курс которой ещё не загружен, - их досчитывает update_currency_rates
+        conn.execute("""
+            CREATE INDEX idx_salary_unconverted ON vacancies(salary_currency)
+            WHERE salary_currency IS NOT NULL AND salary_from_rub IS NULL AND salary_to_rub IS NULL
+        """)
+        conn.execute("""
+            CREATE TABLE currency_rates (
+                code TEXT PRIMARY KEY,
+                rate REAL NOT NULL,
+                updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+            )
+        """)
+        # Гистограммы зарплат по неделям для SalaryAnalytics; пополняются при вставке
+        # и переживают архивацию самих вакансий
+        conn.execute("""
+            CREATE TABLE salary_stats (
+                dimension TEXT NOT NULL,
+                value TEXT NOT NULL,
+                week TEXT NOT NULL,
+                bucket INTEGER NOT NULL,
+                count INTEGER NOT NULL,
+                total INTEGER NOT NULL,
+                PRIMARY KEY (dimension, value, week, bucket)
+            ) WITHOUT ROWID
+        """)
+        # Уже сохранённые вакансии: вилка восстанавливается из отформатированной строки salary
+        cursor = conn.cursor()
+        vacancies = []
+        for row in conn.execute("SELECT id, salary, city, published_ts FROM vacancies").fetchall():
+            salary_from, salary_to, currency = VacancyRenderer.parse_salary(row["salary"])
+            if currency is None:
+                continue
+            vacancies.append(self.normalize_salary(dict(row, salary_from=salary_from, salary_to=salary_to,
+                                                        salary_currency=currency, role=None)))
+        cursor.executemany("""
+            UPDATE vacancies SET salary_from = ?, salary_to = ?, salary_currency = ?,
+                salary_from_rub = ?, salary_to_rub = ?
+            WHERE id = ?
+        """, [(v['salary_from'], v['salary_to'], v['salary_currency'], v['salary_from_rub'], v['salary_to_rub'],
+               v['id']) for v in vacancies])
+        self._update_salary_stats(cursor, vacancies)
+
+    def _migrate_10(self, conn):
+        # Дата публикации у отпечатка: перепост ищется только в окне REPOST_WINDOW_DAYS,
+        # старые отпечатки удаляет cleanup_old_vacancies. Отпечатки уже архивированных вакансий
+        # остаются без даты и ни с чем не совпадают
+        conn.execute("ALTER TABLE vacancy_fingerprints ADD COLUMN published_ts INTEGER")
+        conn.execute("""
+            UPDATE vacancy_fingerprints
+            SET published_ts = (SELECT published_ts FROM vacancies v WHERE v.id = vacancy_fingerprints.id)
+        """)
+        conn.execute("CREATE INDEX idx_fingerprint_published ON vacancy_fingerprints(published_ts)")
+
+    def _migrate_11(self, conn):
+        # cleanup_old_vacancies удаляет отметки о перепостах по created_at - без индекса это полный скан
+        conn.execute("CREATE INDEX idx_duplicates_created ON vacancy_duplicates(created_at)")
+
+    def _migrate_12(self, conn):
+        # Флаг "детали ещё не загружены" с частичным индексом: выборка очереди на дозагрузку
+        # читает только ожидающие вакансии, а не обходит всю таблицу в поисках строк без деталей
+        conn.execute("ALTER TABLE vacancies ADD COLUMN details_pending INTEGER NOT NULL DEFAULT 1")
+        conn.execute("UPDATE vacancies SET details_pending = 0 WHERE id IN (SELECT id FROM vacancy_details)")
+        conn.execute("""
+            CREATE INDEX idx_details_pending ON vacancies(published_ts)
+            WHERE details_pending = 1
+        """)
+
+    def _load_currency_rates(self):
+        with self.get_connection() as conn:
+            rows = conn.execute("SELECT code, rate FROM currency_rates").fetchall()
+        self.currency_rates = {'RUR': 1.0, **{row["code"]: row["rate"] for row in rows}}
+
+    def normalize_salary(self, vacancy):
+        # Курс берётся на момент сохранения и потом не пересчитывается - история остаётся стабильной
+        currency = (vacancy.get('salary_currency') or '').upper()
+        rate = self.currency_rates.get('RUR' if currency == 'RUB' else currency)
+        for field in ('salary_from', 'salary_to'):
+            value = vacancy.get(field)
+            vacancy[f'{field}_rub'] = int(round(value / rate)) if value and rate else None
+        return vacancy
+
+    def update_currency_rates(self, rates):
+        if not rates:
+            return 0
         with self.get_connection() as conn:
             cursor = conn.cursor()
-            cutoff_date = (datetime.now() - timedelta(days=days_to_keep)).strftime("%Y-%m-%d")
-            cursor.execute("DELETE FROM vacancies WHERE date(published_at) < date(?)", (cutoff_date,))
-            deleted = cursor.rowcount
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                cursor.executemany("""
+                    INSERT INTO currency_rates (code, rate) VALUES (?, ?)
+                    ON CONFLICT (code) DO UPDATE SET rate = excluded.rate, updated_at = CURRENT_TIMESTAMP
+                """, list(rates.items()))
+                self.currency_rates = {'RUR': 1.0, **rates}
+                # Вакансии в валюте, для которой курса раньше не было, получают рубли и попадают в статистику
+                rows = cursor.execute("""
+                    SELECT id, salary_from, salary_to, salary_currency, city, role, published_ts FROM vacancies
+                    WHERE salary_currency IS NOT NULL AND salary_from_rub IS NULL AND salary_to_rub IS NULL
+                """).fetchall()
+                vacancies = [v for v in (self.normalize_salary(dict(row)) for row in rows)
+                             if v['salary_from_rub'] or v['salary_to_rub']]
+                cursor.executemany("UPDATE vacancies SET salary_from_rub = ?, salary_to_rub = ? WHERE id = ?",
+                                   [(v['salary_from_rub'], v['salary_to_rub'], v['id']) for v in vacancies])
+                self._update_salary_stats(cursor, vacancies)
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                self._load_currency_rates()
+                raise
+        if vacancies:
+            log(logging.INFO, "Пересчитаны в рубли зарплаты {count} вакансий", count=len(vacancies))
+        return len(vacancies)
+
+    def _update_salary_stats(self, cursor, vacancies):
+        rows = []
+        for vacancy in vacancies:
+            salary = SalaryAnalytics.salary(vacancy)
+            published_ts = vacancy.get('published_ts') or published_timestamp(vacancy.get('published_at'))
+            if not salary or not published_ts:
+                continue
+            week = SalaryAnalytics.week(published_ts)
+            bucket = SalaryAnalytics.bucket(salary)
+            for dimension, value in SalaryAnalytics.dimensions(vacancy.get('city'), vacancy.get('role')):
+                rows.append((dimension, value, week, bucket, salary))
+        cursor.executemany("""
+            INSERT INTO salary_stats (dimension, value, week, bucket, count, total) VALUES (?, ?, ?, ?, 1, ?)
+            ON CONFLICT (dimension, value, week, bucket) DO UPDATE SET
+                count = count + 1,
+                total = total + excluded.total
+        """, rows)
+
+    def salary_histogram(self, dimension, value, week_from=None, week_to=None):
+        with self.get_connection() as conn:
+            return [tuple(row) for row in conn.execute("""
+                SELECT week, bucket, count, total FROM salary_stats
+                WHERE dimension = ? AND value = ? AND week >= ? AND week <= ?
+                ORDER BY week, bucket
+            """, (dimension, value, week_from or "", week_to or "9999"))]
+
+    def sync_channels(self, legacy_channel=None, batch_size=1000):
+        # Новый канал или изменённые правила - прогоняем через маршрутизатор уже сохранённые
+        # вакансии: подошедшие ставятся в очередь, неопубликованные и больше не подходящие из неё
+        # убираются. posted_to_channel переносится в legacy_channel только при самом первом
+        # заполнении channel_posts - потом он означает "опубликовано хоть в один канал".
+        if self.router is None:
+            return
+        with self.get_connection() as conn:
+            if conn.execute("SELECT 1 FROM channel_posts LIMIT 1").fetchone() is not None:
+                legacy_channel = None
+        for rule in self.router.rules:
+            rules_json = json.dumps(rule._asdict(), ensure_ascii=False, sort_keys=True)
+            with self.get_connection() as conn:
+                row = conn.execute("SELECT rules FROM channels WHERE channel = ?", (rule.channel,)).fetchone()
+            if row is not None and row[0] == rules_json:
+                continue
+            router = ChannelRouter([rule])
+            routed = 0
+            dropped = 0
+            with self.get_connection() as conn:
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                rows = conn.execute("""
+                    SELECT id, title, city, published_ts, posted_to_channel, salary_from, salary_to,
+                        salary_currency, salary_from_rub, salary_to_rub
+                    FROM vacancies
+                """)
+                while True:
+                    batch = rows.fetchmany(batch_size)
+                    if not batch:
+                        break
+                    matched = []
+                    unmatched = []
+                    for r in batch:
+                        if router.route(dict(r)):
+                            matched.append((rule.channel, r["id"], r["published_ts"],
+                                            1 if rule.channel == legacy_channel and r["posted_to_channel"] else 0))
+                        else:
+                            unmatched.append((rule.channel, r["id"]))
+                    cursor.executemany("""
+                        INSERT OR IGNORE INTO channel_posts (channel, vacancy_id, published_ts, posted)
+                        VALUES (?, ?, ?, ?)
+                    """, matched)
+                    cursor.executemany("""
+                        DELETE FROM channel_posts WHERE channel = ? AND vacancy_id = ? AND posted = 0
+                    """, unmatched)
+                    routed += len(matched)
+                    dropped += cursor.rowcount if unmatched else 0
+                cursor.execute("""
+                    INSERT INTO channels (channel, rules) VALUES (?, ?)
+                    ON CONFLICT (channel) DO UPDATE SET rules = excluded.rules, updated_at = CURRENT_TIMESTAMP
+                """, (rule.channel, rules_json))
+                conn.commit()
+            log(logging.INFO, "Канал {channel}: в очередь поставлено {routed} сохранённых вакансий, "
+                "снято с очереди {dropped}", channel=rule.channel, routed=routed, dropped=dropped)
+
+    def get_crawl_plan(self, area, query="", max_age=None):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT plan, created_ts FROM crawl_plans WHERE area = ? AND query = ?",
+                           (area, query))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        if max_age is not None and time.time() - row[1] > max_age.total_seconds():
+            return None
+        return json.loads(row[0])
+
+    def save_crawl_plan(self, area, query, leaves):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                INSERT INTO crawl_plans (area, query, plan, created_ts) VALUES (?, ?, ?, ?)
+                ON CONFLICT (area, query) DO UPDATE SET plan = excluded.plan, created_ts = excluded.created_ts
+            """, (area, query, json.dumps(leaves), int(time.time())))
+            conn.commit()
+
+    def enriched_ids(self, ids):
+        ids = list(ids)
+        if not ids:
+            return set()
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            placeholders = ",".join("?" * len(ids))
+            cursor.execute(f"SELECT id FROM vacancy_details WHERE id IN ({placeholders})", ids)
+            return {row[0] for row in cursor.fetchall()}
+
+    def unenriched_ids(self, limit=500):
+        with self.get_connection() as conn:
+            return [row[0] for row in conn.execute("""
+                SELECT id FROM vacancies
+                WHERE details_pending = 1
+                ORDER BY published_ts DESC
+                LIMIT ?
+            """, (limit,))]
+
+    def save_vacancy_details(self, details):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("""
+                INSERT INTO vacancy_details (id, key_skills, schedule, employment, experience, description)
+                VALUES (?, ?, ?, ?, ?, ?)
+                ON CONFLICT (id) DO NOTHING
+            """, [(d['id'], json.dumps(d['key_skills'], ensure_ascii=False), d['schedule'],
+                   d['employment'], d['experience'], d['description']) for d in details])
+            cursor.executemany("UPDATE vacancies SET details_pending = 0 WHERE id = ? AND details_pending = 1",
+                               [(d['id'],) for d in details])
             conn.commit()
-            if deleted:
-                print(f"Удалено {deleted} старых вакансий (старше {days_to_keep} дней)")
+
+    def get_vacancy_details(self, vacancy_id):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("SELECT * FROM vacancy_details WHERE id = ?", (vacancy_id,))
+            row = cursor.fetchone()
+        if row is None:
+            return None
+        details = dict(row)
+        details['key_skills'] = json.loads(details['key_skills'] or "[]")
+        return details
+
+    @staticmethod
+    def _known_ids(cursor, ids):
+        # Известными считаются и сохранённые вакансии, и отброшенные как перепосты
+        known = set()
+        for i in range(0, len(ids), 400):
+            chunk = ids[i:i + 400]
+            placeholders = ",".join("?" * len(chunk))
+            cursor.execute(f"""
+                SELECT id FROM vacancies WHERE id IN ({placeholders})
+                UNION ALL
+                SELECT id FROM vacancy_duplicates WHERE id IN ({placeholders})
+            """, chunk + chunk)
+            known.update(row[0] for row in cursor.fetchall())
+        return known
+
+    def existing_ids(self, ids):
+        ids = list(ids)
+        if not ids:
+            return set()
+        with self.get_connection() as conn:
+            return self._known_ids(conn.cursor(), ids)
+
+    ARCHIVE_COLUMNS = """
+        v.id, v.title, v.company, v.salary, v.url, v.published_at, v.published_ts, v.source, v.city,
+        v.posted_to_channel, v.created_at, v.salary_from, v.salary_to, v.salary_currency,
+        v.salary_from_rub, v.salary_to_rub, v.role,
+        d.key_skills, d.schedule, d.employment, d.experience, d.description
+    """
+
+    def cleanup_old_vacancies(self, days_to_keep=30, archive=None, batch_size=5000):
+        # Пачками: сначала строки пишутся в архив, потом удаляются; блокировка записи держится
+        # только на время одной пачки
+        cutoff_date = (datetime.now() - timedelta(days=days_to_keep)).replace(
+            hour=0, minute=0, second=0, microsecond=0)
+        cutoff = int(cutoff_date.timestamp())
+        deleted = 0
+        while True:
+            with self.get_connection() as conn:
+                rows = conn.execute(f"""
+                    SELECT {self.ARCHIVE_COLUMNS} FROM vacancies v
+                    LEFT JOIN vacancy_details d ON d.id = v.id
+                    WHERE v.published_ts < ?
+                    ORDER BY v.published_ts
+                    LIMIT ?
+                """, (cutoff, batch_size)).fetchall()
+                if not rows:
+                    break
+                if archive is not None:
+                    archive.write([dict(row) for row in rows])
+                ids = [(row["id"],) for row in rows]
+                cursor = conn.cursor()
+                cursor.execute("BEGIN IMMEDIATE")
+                try:
+                    cursor.executemany("DELETE FROM vacancies WHERE id = ?", ids)
+                    cursor.executemany("DELETE FROM vacancy_details WHERE id = ?", ids)
+                    conn.commit()
+                except Exception:
+                    conn.rollback()
+                    raise
+            deleted += len(rows)
+        with self.get_connection() as conn:
+            conn.execute("DELETE FROM channel_posts WHERE published_ts < ?", (cutoff,))
+            # Отпечатки нужны, пока в окно загрузки может прийти вакансия, с которой они совпадут
+            conn.execute("DELETE FROM vacancy_fingerprints WHERE published_ts IS NULL OR published_ts < ?",
+                         (cutoff - DuplicateDetector.REPOST_WINDOW_DAYS * 86400,))
+            conn.execute("DELETE FROM vacancy_duplicates WHERE created_at < datetime(?, 'unixepoch')", (cutoff,))
+            conn.commit()
+        if deleted:
+            action = "Перенесено в архив" if archive is not None else "Удалено"
+            log(logging.INFO, "{action} {deleted} старых вакансий (старше {days} дней)", action=action,
+                deleted=deleted, days=days_to_keep, archived=archive is not None)
+            self.incremental_vacuum()
+        return deleted
+
+    def incremental_vacuum(self, max_pages=None):
+        # Возвращает освободившиеся страницы файлу; в WAL-режиме файл уменьшается после checkpoint
+        with self.get_connection() as conn:
+            free_pages = conn.execute("PRAGMA freelist_count").fetchone()[0]
+            if not free_pages:
+                return 0
+            pragma = f"PRAGMA incremental_vacuum({int(max_pages)})" if max_pages else "PRAGMA incremental_vacuum"
+            # execute() делает один шаг прагмы - одну страницу; executescript прогоняет её до конца
+            conn.executescript(pragma)
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)").fetchall()
+        log(logging.INFO, "Освобождено страниц БД: {pages}", pages=free_pages)
+        return free_pages
 
     def vacancy_exists(self, vacancy_id):
         with self.get_connection() as conn:
@@ -279,227 +2191,553 @@ class VacancyDatabase:
             cursor.execute("SELECT 1 FROM vacancies WHERE id = ?", (vacancy_id,))
             return cursor.fetchone() is not None
 
-    def save_vacancy(self, vacancy):
-        if self.vacancy_exists(vacancy['id']):
-            return False
-        with self.get_connection() as conn:
+    def _vacancy_row(self, vacancy):
+        return (
+            vacancy['id'],
+            vacancy['title'][:500],
+            vacancy['company'][:200],
+            vacancy['salary'][:100],
+            vacancy['url'],
+            vacancy['published_at'],
+            vacancy['source'],
+            vacancy['city'],
+            published_timestamp(vacancy['published_at']),
+            self._render(vacancy),
+            vacancy.get('salary_from'),
+            vacancy.get('salary_to'),
+            vacancy.get('salary_currency'),
+            vacancy.get('salary_from_rub'),
+            vacancy.get('salary_to_rub'),
+            vacancy.get('role'),
+        )
+
+    def _render(self, vacancy):
+        with METRICS.timer("render"):
+            return self.renderer.render(vacancy)
+
+    def save_vacancies(self, vacancies):
+        # Одно соединение и одна транзакция на всю пачку
+        by_id = {}
+        for vacancy in vacancies:
+            by_id.setdefault(vacancy['id'], vacancy)
+        if not by_id:
+            return []
+        with self.get_connection() as conn, METRICS.timer("db_write"):
             cursor = conn.cursor()
-            cursor.execute("""
-                INSERT OR IGNORE INTO vacancies 
-                (id, title, company, salary, url, published_at, source, city)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-            """, (
-                vacancy['id'],
-                vacancy['title'][:500],
-                vacancy['company'][:200],
-                vacancy['salary'][:100],
-                vacancy['url'],
-                vacancy['published_at'],
-                vacancy['source'],
-                vacancy['city']
-            ))
-            conn.commit()
-            return cursor.rowcount > 0
+            try:
+                cursor.execute("BEGIN IMMEDIATE")
+                known = self._known_ids(cursor, list(by_id))
+                inserted = []
+                duplicates = []
+                for vacancy_id, vacancy in by_id.items():
+                    if vacancy_id in known:
+                        continue
+                    fp = self.duplicates.fingerprint(vacancy)
+                    published_ts = published_timestamp(vacancy['published_at'])
+                    original_id = self.duplicates.find(cursor, fp, published_ts)
+                    if original_id is not None:
+                        duplicates.append((vacancy_id, original_id))
+                        continue
+                    self.duplicates.remember(cursor, vacancy_id, fp, published_ts)
+                    self.normalize_salary(vacancy)
+                    inserted.append(vacancy_id)
+                cursor.executemany("""
+                    INSERT INTO vacancies
+                    (id, title, company, salary, url, published_at, source, city, published_ts, message_text,
+                     salary_from, salary_to, salary_currency, salary_from_rub, salary_to_rub, role)
+                    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                    ON CONFLICT (id) DO NOTHING
+                """, [self._vacancy_row(by_id[vacancy_id]) for vacancy_id in inserted])
+                self._update_salary_stats(cursor, [by_id[vacancy_id] for vacancy_id in inserted])
+                cursor.executemany("INSERT OR IGNORE INTO vacancy_duplicates (id, original_id) VALUES (?, ?)",
+                                   duplicates)
+                if self.router is not None:
+                    cursor.executemany("""
+                        INSERT OR IGNORE INTO channel_posts (channel, vacancy_id, published_ts)
+                        VALUES (?, ?, ?)
+                    """, [(channel, vacancy_id, published_timestamp(by_id[vacancy_id]['published_at']))
+                          for vacancy_id in inserted for channel in self.router.route(by_id[vacancy_id])])
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+            if duplicates:
+                log(logging.INFO, "  Пропущено перепостов: {count}", count=len(duplicates))
+            return inserted
+
+    def save_vacancy(self, vacancy):
+        return bool(self.save_vacancies([vacancy]))
 
     def get_unposted_vacancies(self, limit=10):
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("""
-                SELECT * FROM vacancies 
-                WHERE posted_to_channel = 0 
-                ORDER BY 
-                    CASE WHEN published_at > datetime('now', '-1 day') THEN 1 ELSE 2 END,
-                    published_at DESC 
+                SELECT * FROM vacancies
+                WHERE posted_to_channel = 0
+                ORDER BY published_ts DESC
                 LIMIT ?
             """, (limit,))
             rows = cursor.fetchall()
             return [dict(row) for row in rows]
 
+    def get_channel_queue(self, channel, limit=10):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                SELECT v.* FROM channel_posts cp
+                JOIN vacancies v ON v.id = cp.vacancy_id
+                WHERE cp.channel = ? AND cp.posted = 0
+                ORDER BY cp.published_ts DESC
+                LIMIT ?
+            """, (channel, limit))
+            return [dict(row) for row in cursor.fetchall()]
+
+    def count_channel_queue(self, channel):
+        with self.get_connection() as conn:
+            # Без подсказки планировщик берёт первичный ключ и читает все уже опубликованные строки канала
+            return conn.execute("""
+                SELECT COUNT(*) FROM channel_posts INDEXED BY idx_channel_queue
+                WHERE channel = ? AND posted = 0 AND next_attempt_at <= ?
+            """, (channel, int(time.time()))).fetchone()[0]
+
+    def claim_channel_post(self, channel, worker_id, lease_seconds=300):
+        # BEGIN IMMEDIATE сериализует захват между процессами: строку с живой арендой никто не получит
+        now = int(time.time())
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("BEGIN IMMEDIATE")
+            try:
+                row = cursor.execute("""
+                    SELECT vacancy_id FROM channel_posts
+                    WHERE channel = ? AND posted = 0 AND next_attempt_at <= ?
+                      AND (claimed_at IS NULL OR claimed_at <= ?)
+                    ORDER BY published_ts DESC
+                    LIMIT 1
+                """, (channel, now, now - lease_seconds)).fetchone()
+                if row is None:
+                    conn.commit()
+                    return None
+                cursor.execute("""
+                    UPDATE channel_posts SET claimed_by = ?, claimed_at = ?, attempts = attempts + 1
+                    WHERE channel = ? AND vacancy_id = ?
+                """, (worker_id, now, channel, row[0]))
+                vacancy = cursor.execute("""
+                    SELECT v.*, cp.attempts FROM channel_posts cp
+                    JOIN vacancies v ON v.id = cp.vacancy_id
+                    WHERE cp.channel = ? AND cp.vacancy_id = ?
+                """, (channel, row[0])).fetchone()
+                conn.commit()
+            except Exception:
+                conn.rollback()
+                raise
+        return dict(vacancy) if vacancy is not None else None
+
+    def renew_channel_post(self, channel, vacancy_id, worker_id):
+        # Продление аренды перед каждой попыткой отправки; False - строку уже забрал другой исполнитель
+        with self.get_connection() as conn:
+            renewed = conn.execute("""
+                UPDATE channel_posts SET claimed_at = ?
+                WHERE channel = ? AND vacancy_id = ? AND claimed_by = ? AND posted = 0
+            """, (int(time.time()), channel, vacancy_id, worker_id)).rowcount
+            conn.commit()
+        return renewed == 1
+
+    def complete_channel_post(self, channel, vacancy_id, message_id, worker_id):
+        # message_id и отметка об отправке пишутся одной транзакцией, и только владельцем аренды
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute("""
+                UPDATE channel_posts SET posted = 1, posted_at = CURRENT_TIMESTAMP, message_id = ?,
+                    claimed_by = NULL, claimed_at = NULL, last_error = NULL
+                WHERE channel = ? AND vacancy_id = ? AND claimed_by = ? AND posted = 0
+            """, (message_id, channel, vacancy_id, worker_id))
+            completed = cursor.rowcount == 1
+            if completed:
+                cursor.execute("UPDATE vacancies SET posted_to_channel = 1 WHERE id = ?", (vacancy_id,))
+            conn.commit()
+        return completed
+
+    def fail_channel_post(self, channel, vacancy_id, worker_id, error, next_attempt_at):
+        # next_attempt_at = None - попытки исчерпаны, строка уходит из очереди
+        with self.get_connection() as conn:
+            if next_attempt_at is None:
+                conn.execute("""
+                    UPDATE channel_posts SET posted = 2, claimed_by = NULL, claimed_at = NULL, last_error = ?
+                    WHERE channel = ? AND vacancy_id = ? AND claimed_by = ? AND posted = 0
+                """, (error, channel, vacancy_id, worker_id))
+            else:
+                conn.execute("""
+                    UPDATE channel_posts SET next_attempt_at = ?, claimed_by = NULL, claimed_at = NULL,
+                        last_error = ?
+                    WHERE channel = ? AND vacancy_id = ? AND claimed_by = ? AND posted = 0
+                """, (next_attempt_at, error, channel, vacancy_id, worker_id))
+            conn.commit()
+
+    def release_channel_posts(self, worker_id, channel=None, vacancy_id=None):
+        sql = """
+            UPDATE channel_posts SET claimed_by = NULL, claimed_at = NULL, attempts = MAX(attempts - 1, 0)
+            WHERE claimed_by = ? AND posted = 0
+        """
+        params = [worker_id]
+        if channel is not None:
+            sql += " AND channel = ? AND vacancy_id = ?"
+            params += [channel, vacancy_id]
+        with self.get_connection() as conn:
+            released = conn.execute(sql, params).rowcount
+            conn.commit()
+        return released
+
     def mark_as_posted(self, vacancy_id):
         with self.get_connection() as conn:
             cursor = conn.cursor()
             cursor.execute("UPDATE vacancies SET posted_to_channel = 1 WHERE id = ?", (vacancy_id,))
             conn.commit()
 
+    def vacuum(self):
+        with self.get_connection() as conn:
+            conn.execute("PRAGMA optimize")
+            conn.execute("VACUUM")
+            conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        log(logging.INFO, "База данных сжата")
+
+    def mark_as_posted_many(self, vacancy_ids):
+        with self.get_connection() as conn:
+            cursor = conn.cursor()
+            cursor.executemany("UPDATE vacancies SET posted_to_channel = 1 WHERE id = ?",
+                               [(vacancy_id,) for vacancy_id in vacancy_ids])
+            conn.commit()
+
 
-def run_aggregator(publisher, channel_username, exit_controller):
-    print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Запуск агрегатора...")
-    print(f"Используется канал: {channel_username}")
+class SalaryAnalytics:
+    # Перцентили и тренды зарплат по гистограммам salary_stats: запрос читает сотни строк сводки,
+    # а не все вакансии. Корзины - геометрическая сетка с шагом 5%, это и есть точность перцентилей
+    BASE = 1000
+    STEP = 1.05
+    POINTS = (10, 25, 50, 75, 90)
+
+    def __init__(self, db):
+        self.db = db
+
+    @staticmethod
+    def salary(vacancy):
+        values = [value for value in (vacancy.get('salary_from_rub'), vacancy.get('salary_to_rub')) if value]
+        return sum(values) // len(values) if values else None
+
+    @classmethod
+    def bucket(cls, salary):
+        return max(0, int(math.log(salary / cls.BASE, cls.STEP)))
+
+    @staticmethod
+    def week(published_ts):
+        return datetime.fromtimestamp(published_ts).strftime('%G-W%V')
+
+    @staticmethod
+    def dimensions(city, role):
+        yield "all", ""
+        if city:
+            yield "city", city
+        if role:
+            yield "role", str(role)
+        if city and role:
+            yield "city_role", f"{city}|{role}"
+
+    @staticmethod
+    def dimension(city=None, role=None):
+        if city and role:
+            return "city_role", f"{city}|{role}"
+        if city:
+            return "city", city
+        if role:
+            return "role", str(role)
+        return "all", ""
+
+    @classmethod
+    def _summary(cls, buckets, total, points):
+        count = sum(buckets.values())
+        summary = {"count": count, "mean": round(total / count) if count else None}
+        ordered = sorted(buckets.items())
+        for point in points:
+            summary[f"p{point}"] = cls._percentile(ordered, count, point) if count else None
+        return summary
+
+    @classmethod
+    def _percentile(cls, ordered, count, point):
+        # Внутри корзины - интерполяция по геометрической шкале
+        rank = point / 100 * count
+        seen = 0
+        for bucket, n in ordered:
+            if seen + n >= rank:
+                return round(cls.BASE * cls.STEP ** (bucket + (rank - seen) / n))
+            seen += n
+        return round(cls.BASE * cls.STEP ** (ordered[-1][0] + 1))
+
+    @staticmethod
+    def _week_from(weeks):
+        if not weeks:
+            return None
+        return (datetime.now() - timedelta(weeks=weeks - 1)).strftime('%G-W%V')
+
+    def percentiles(self, city=None, role=None, weeks=None, points=POINTS):
+        buckets = {}
+        total = 0
+        for _, bucket, count, bucket_total in self.db.salary_histogram(*self.dimension(city, role),
+                                                                       self._week_from(weeks)):
+            buckets[bucket] = buckets.get(bucket, 0) + count
+            total += bucket_total
+        return self._summary(buckets, total, points)
+
+    def trend(self, city=None, role=None, weeks=12, points=(50,)):
+        by_week = {}
+        for week, bucket, count, bucket_total in self.db.salary_histogram(*self.dimension(city, role),
+                                                                          self._week_from(weeks)):
+            buckets, total = by_week.get(week, ({}, 0))
+            buckets[bucket] = count
+            by_week[week] = (buckets, total + bucket_total)
+        return [dict(week=week, **self._summary(buckets, total, points))
+                for week, (buckets, total) in sorted(by_week.items())]
+
+
+def run_aggregator(publisher, channel_username, exit_controller, jobs=None, db=None, parser=None):
+    # db и parser можно передать снаружи, чтобы не открывать БД и HTTP-сессию заново каждый цикл
+    log(logging.INFO, "\n[{time:%Y-%m-%d %H:%M:%S}] Запуск агрегатора...", time=datetime.now())
+    log(logging.INFO, "Используется канал: {channel}", channel=channel_username)
 
     if exit_controller.exit_now:
-        print("Получен запрос на выход, завершаю работу...")
+        log(logging.INFO, "Получен запрос на выход, завершаю работу...")
         return False
 
-    db = VacancyDatabase()
-    parser = HHruParser()
+    own_db = db is None
+    if own_db:
+        db = VacancyDatabase(router=ChannelRouter([ChannelRule(channel_username)]))
+        db.sync_channels(legacy_channel=channel_username)
+    parser = parser or HHruParser()
+    try:
+        return run_cycle(publisher, channel_username, exit_controller, db, parser, jobs)
+    finally:
+        if own_db:
+            db.close()
+
+
+def run_cycle(publisher, channel_username, exit_controller, db, parser, jobs=None):
+    db.cleanup_old_vacancies(30, archive=VacancyArchive(os.getenv('ARCHIVE_DIR', 'archive')))
 
+    # Бот проверяется после загрузки: до первого запроса к HH не бывает лишних сетевых обращений
+    if fetch_cycle(db, parser, exit_controller, jobs) is None:
+        return False
     if not publisher.check_bot():
-        print("Ошибка: бот не работает. Проверьте токен.")
+        log(logging.ERROR, "Ошибка: бот не работает. Проверьте токен.")
         return False
+    publish_cycle(publisher, db, channel_username, exit_controller)
 
-    if datetime.now().weekday() == 0:
-        db.cleanup_old_vacancies(30)
+    log(logging.INFO, "\n[{time:%Y-%m-%d %H:%M:%S}] Завершено!", time=datetime.now())
+    return True
 
-    print("\nПолучаем вакансии с HH.ru...")
-    vacancies = parser.fetch_vacancies("Пермь", period_days=30)
 
-    new_count = 0
-    for vacancy in vacancies:
+def fetch_cycle(db, parser, exit_controller, jobs=None):
+    log(logging.INFO, "\nПолучаем вакансии с HH.ru...")
+    if not jobs:
+        jobs = [FetchJob("Пермь", None, 30)]
+    try:
+        db.update_currency_rates(parser.currency_rates())
+    except Exception as e:
+        log(logging.WARNING, "Не удалось обновить курсы валют, остаются прежние: {error}", error=e)
+    fetcher = IncrementalFetcher(parser, db)
+    writer = VacancyBatchWriter(db)
+    # Каждая страница пишется в БД сразу, пока следующие ещё загружаются
+    for page_vacancies in fetcher.iter_pages(jobs):
         if exit_controller.exit_now:
             break
-        if db.save_vacancy(vacancy):
-            new_count += 1
-    print(f"\nНовых вакансий сохранено в БД: {new_count}")
-
-    # --- ИЗМЕНЕНИЕ: случайное количество вакансий от 11 до 22 ---
-    limit = random.randint(11, 22)
-    print(f"Будет запрошено до {limit} неопубликованных вакансий")
-    unposted = db.get_unposted_vacancies(limit)
-    print(f"Найдено неопубликованных вакансий: {len(unposted)}")
-
-    if unposted:
-        print(f"\nПубликую вакансии в канал {channel_username}...")
-        posted_count = 0
-        for i, vacancy in enumerate(unposted, 1):
-            if exit_controller.exit_now or publisher.exit_flag:
-                print("Получен запрос на выход, прерываю публикацию...")
+        writer.add(page_vacancies)
+    new_ids = writer.flush()
+    log(logging.INFO, "\nНовых вакансий сохранено в БД: {count}", count=len(new_ids))
+    if exit_controller.exit_now:
+        log(logging.INFO, "Получен запрос на выход, завершаю работу...")
+        return None
+    fetcher.commit()
+    # Не только новые: заодно догружаются детали, не полученные в прошлых циклах
+    VacancyEnricher(parser, db).enrich(exit_controller=exit_controller)
+    return new_ids
+
+
+def publish_cycle(publisher, db, channels, exit_controller, limit=None, outbox=None):
+    if isinstance(channels, str):
+        channels = [channels]
+    # getMe кешируется в publisher, поэтому проверка здесь не стоит сетевого запроса каждый цикл
+    if not publisher.check_bot():
+        log(logging.ERROR, "Ошибка: бот не работает, публикация пропущена. Проверьте токен.")
+        return 0
+    publish_queue = PublishQueue(publisher, outbox or Outbox(db), exit_controller)
+    for channel in channels:
+        # --- ИЗМЕНЕНИЕ: случайное количество вакансий от 11 до 22 ---
+        channel_limit = limit if limit is not None else random.randint(11, 22)
+        pending = db.count_channel_queue(channel)
+        log(logging.INFO, "Канал {channel}: неопубликованных вакансий {pending} (лимит {limit})",
+            channel=channel, pending=pending, limit=channel_limit)
+        if pending:
+            publish_queue.put(channel, channel_limit)
+
+    if not len(publish_queue):
+        log(logging.INFO, "\nНет новых вакансий для публикации")
+        return 0
+    log(logging.INFO, "\nПубликую вакансии в каналы: {channels}...", channels=", ".join(channels))
+    results = publish_queue.run()
+    posted_count = sum(len(ids) for ids in results.values())
+    log(logging.INFO, "\nОпубликовано в каналах: {count} вакансий", count=posted_count)
+    return posted_count
+
+
+ScheduledJob = namedtuple("ScheduledJob", ["name", "func", "min_seconds", "max_seconds"])
+
+
+class Scheduler:
+    # Задачи со своими интервалами (случайными в [min, max]); между запусками процесс спит
+    # на событии GracefulExit до ближайшего срока и просыпается сразу по SIGINT/SIGTERM
+    def __init__(self, exit_controller):
+        self.exit_controller = exit_controller
+        self._heap = []
+        self._counter = itertools.count()
+
+    def every(self, name, func, min_seconds, max_seconds=None, run_now=False):
+        job = ScheduledJob(name, func, min_seconds, max_seconds or min_seconds)
+        self._push(job, 0 if run_now else self._interval(job))
+
+    @staticmethod
+    def _interval(job):
+        return random.uniform(job.min_seconds, job.max_seconds)
+
+    def _push(self, job, delay):
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), job))
+        if delay:
+            next_run = datetime.now() + timedelta(seconds=delay)
+            log(logging.INFO, "  {job}: следующий запуск через {hours} ч {minutes} мин ({next_run:%Y-%m-%d %H:%M:%S})",
+                job=job.name, hours=int(delay // 3600), minutes=int(delay % 3600 // 60), next_run=next_run)
+
+    def run(self):
+        while self._heap and not self.exit_controller.exit_now:
+            deadline, _, job = self._heap[0]
+            if self.exit_controller.wait(deadline - time.monotonic()):
                 break
-            print(f"  {i}. {vacancy['title'][:50]}...")
-            success = publisher.send_to_channel(channel_username, vacancy)
-            if success:
-                db.mark_as_posted(vacancy['id'])
-                posted_count += 1
-                if i < len(unposted):
-                    print(f"    Пауза 2 секунды...")
-                    for _ in range(20):
-                        if exit_controller.exit_now:
-                            break
-                        time.sleep(0.1)
-            else:
-                print(f"    Не удалось отправить вакансию")
-        print(f"\nОпубликовано в канале: {posted_count} вакансий")
-    else:
-        print("\nНет новых вакансий для публикации")
+            if time.monotonic() < deadline:
+                continue
+            heapq.heappop(self._heap)
+            log(logging.INFO, "\n[{time:%Y-%m-%d %H:%M:%S}] Задача: {job}", time=datetime.now(), job=job.name)
+            try:
+                job.func()
+            except Exception as e:
+                log(logging.ERROR, "Ошибка в задаче {job}: {error}", exc_info=True, job=job.name, error=e)
+            if self.exit_controller.exit_now:
+                break
+            self._push(job, self._interval(job))
 
-    print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Завершено!")
-    return True
 
+def parse_interval(value, default):
+    # "3600" или "3600-14400" (секунды)
+    if not value:
+        return default
+    low, _, high = value.partition('-')
+    return int(low), int(high or low)
 
-def job(publisher, channel_username, exit_controller):
+
+def job(publisher, channel_username, exit_controller, jobs=None, db=None, parser=None):
     try:
-        return run_aggregator(publisher, channel_username, exit_controller)
+        return run_aggregator(publisher, channel_username, exit_controller, jobs, db, parser)
     except KeyboardInterrupt:
-        print("Задача прервана пользователем")
+        log(logging.INFO, "Задача прервана пользователем")
         exit_controller.exit_now = True
         return False
     except Exception as e:
-        print(f"Ошибка в задаче: {e}")
-        import traceback
-        traceback.print_exc()
+        log(logging.ERROR, "Ошибка в задаче: {error}", exc_info=True, error=e)
         return False
 
 
 if __name__ == "__main__":
-    print(f"[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Запуск агрегатора вакансий...")
-    print("=" * 60)
+    arg_parser = argparse.ArgumentParser(description="Агрегатор вакансий HH.ru для Telegram-каналов")
+    arg_parser.add_argument("--once", action="store_true",
+                            help="один цикл (архивация, загрузка, публикация) и выход - для cron и контейнеров")
+    ARGS = arg_parser.parse_args()
+
+    # LOG_FORMAT=json - по строке JSON на событие; LOG_LEVEL=DEBUG - с параметрами запросов к HH
+    configure_logging(os.getenv('LOG_FORMAT', 'text'), os.getenv('LOG_LEVEL', 'INFO'))
+    log(logging.INFO, "[{time:%Y-%m-%d %H:%M:%S}] Запуск агрегатора вакансий...", time=datetime.now())
+    log_separator()
 
     BOT_TOKEN = os.getenv('BOT_TOKEN')
     CHANNEL_USERNAME = os.getenv('CHANNEL_USERNAME')
 
     if not BOT_TOKEN:
-        print("❌ Ошибка: не задана переменная окружения BOT_TOKEN")
+        log(logging.ERROR, "❌ Ошибка: не задана переменная окружения BOT_TOKEN")
         sys.exit(1)
     if not CHANNEL_USERNAME:
-        print("❌ Ошибка: не задана переменная окружения CHANNEL_USERNAME")
+        log(logging.ERROR, "❌ Ошибка: не задана переменная окружения CHANNEL_USERNAME")
         sys.exit(1)
 
-    # УСИЛЕННЫЙ ТЕСТ ДОСТУПА К HH.RU
-    try:
-        test_resp = requests.get("https://api.hh.ru/vacancies?area=59&per_page=3", timeout=10)
-        print(f"Тест доступа к HH.ru: {test_resp.status_code}")
-        print(f"Тело ответа (первые 500): {test_resp.text[:500]}")
-        if test_resp.status_code == 200:
-            data = test_resp.json()
-            found = data.get('found', 0)
-            print(f"✓ HH.ru доступен, найдено вакансий в Перми (всего): {found}")
-        else:
-            print(f"✗ HH.ru вернул статус {test_resp.status_code}")
-    except Exception as e:
-        print(f"✗ Не удалось подключиться к HH.ru: {e}")
+    # Города и поисковые запросы через запятую; по умолчанию - только Пермь без ключевых слов
+    HH_CITIES = [c.strip() for c in os.getenv('HH_CITIES', 'Пермь').split(',') if c.strip()]
+    HH_QUERIES = [q.strip() for q in os.getenv('HH_QUERIES', '').split(',') if q.strip()]
+    FETCH_JOBS = build_fetch_jobs(HH_CITIES, HH_QUERIES, period_days=30)
+    # Каналы и их фильтры - JSON-файл CHANNELS_CONFIG; без него все вакансии идут в CHANNEL_USERNAME
+    CHANNEL_RULES = load_channel_rules(os.getenv('CHANNELS_CONFIG'), CHANNEL_USERNAME)
+
+    HTTP_CACHE = HTTPCache(os.getenv('HTTP_CACHE_PATH', 'http_cache.db'))
+    for counter in ("hits", "misses", "not_modified"):
+        METRICS.gauge("http_cache_requests", lambda counter=counter: HTTP_CACHE.stats()[counter], result=counter)
+    # Парсер и БД создаются один раз на весь процесс; отдельной проверки HH.ru и бота при старте нет -
+    # первая загрузка и первая публикация сами сообщат об ошибке
+    parser = HHruParser(cache=HTTP_CACHE)
 
     exit_controller = GracefulExit()
     publisher = TelegramChannelPublisher(BOT_TOKEN)
 
-    print("Конфигурация:")
-    print(f"  Бот токен: {'✓ задан' if BOT_TOKEN else '✗ отсутствует'}")
-    print(f"  Канал: {CHANNEL_USERNAME}")
-    print("=" * 60)
-
-    if not publisher.check_bot():
-        print("❌ Ошибка: Бот не работает. Проверьте токен и интернет-соединение.")
-        print("Для выхода нажмите Ctrl+C")
-        try:
-            while not exit_controller.exit_now:
-                time.sleep(1)
-        except KeyboardInterrupt:
-            sys.exit(1)
-
-    print("\nПервый запуск...")
+    log(logging.INFO, "Конфигурация:\n  Бот токен: {token}\n  Каналы: {channels}\n  Города: {cities}\n  Запросы: {queries}",
+        token="✓ задан" if BOT_TOKEN else "✗ отсутствует",
+        channels=", ".join(rule.channel for rule in CHANNEL_RULES), cities=", ".join(HH_CITIES),
+        queries=", ".join(HH_QUERIES) if HH_QUERIES else "—")
+    log_separator()
+
+    # Интервалы в секундах, "мин-макс": загрузка по каждому городу и публикация - отдельно
+    FETCH_INTERVAL = parse_interval(os.getenv('FETCH_INTERVAL'), (3600, 14400))
+    PUBLISH_INTERVAL = parse_interval(os.getenv('PUBLISH_INTERVAL'), (3600, 14400))
+
+    db = VacancyDatabase(router=ChannelRouter(CHANNEL_RULES))
+    db.sync_channels(legacy_channel=CHANNEL_USERNAME)
+    # API_PORT (или прежний METRICS_PORT) - HTTP-сервер с /metrics и аналитикой зарплат
+    API_PORT = os.getenv('API_PORT') or os.getenv('METRICS_PORT')
+    if API_PORT:
+        start_api_server(int(API_PORT), analytics=SalaryAnalytics(db))
+    # Вакансии старше 30 дней уходят в сжатый архив ARCHIVE_DIR, рабочая БД остаётся маленькой
+    ARCHIVE = VacancyArchive(os.getenv('ARCHIVE_DIR', 'archive'))
+    scheduler = Scheduler(exit_controller)
+    if not ARGS.once:
+        for city in HH_CITIES:
+            city_jobs = [fetch_job for fetch_job in FETCH_JOBS if fetch_job.area == city]
+            scheduler.every(f"загрузка: {city}",
+                            lambda city_jobs=city_jobs: fetch_cycle(db, parser, exit_controller, city_jobs),
+                            *FETCH_INTERVAL, run_now=True)
+        scheduler.every("публикация", lambda: publish_cycle(publisher, db, db.router.channels, exit_controller),
+                        *PUBLISH_INTERVAL, run_now=True)
+        scheduler.every("архивация старых вакансий", lambda: db.cleanup_old_vacancies(30, archive=ARCHIVE),
+                        86400, 90000, run_now=True)
+        scheduler.every("сжатие БД", db.vacuum, 7 * 86400, 8 * 86400)
+
+        log_separator()
+        log(logging.INFO, "Агрегатор запущен. Загрузка: каждые {fetch_min}–{fetch_max} мин, "
+            "публикация: каждые {publish_min}–{publish_max} мин\nДля остановки нажмите Ctrl+C",
+            fetch_min=FETCH_INTERVAL[0] // 60, fetch_max=FETCH_INTERVAL[1] // 60,
+            publish_min=PUBLISH_INTERVAL[0] // 60, publish_max=PUBLISH_INTERVAL[1] // 60)
+
+    exit_code = 0
     try:
-        job_success = job(publisher, CHANNEL_USERNAME, exit_controller)
-    except Exception as e:
-        print(f"Ошибка при первом запуске: {e}")
-        job_success = False
-
-    # --- ИЗМЕНЕНИЕ: ручное планирование со случайным интервалом ---
-    # После первого запуска вычисляем случайное время ожидания до следующего (от 1 до 4 часов)
-    if not exit_controller.exit_now:
-        # Генерируем случайный интервал в секундах
-        interval_seconds = random.randint(3600, 14400)  # 1–4 часа
-        next_run = datetime.now() + timedelta(seconds=interval_seconds)
-        print(f"\nСледующий запуск через {interval_seconds // 3600} ч {interval_seconds % 3600 // 60} мин")
-        print(f"Ожидание до {next_run.strftime('%Y-%m-%d %H:%M:%S')}")
-    else:
-        next_run = None
-
-    print("\n" + "=" * 60)
-    print("Агрегатор запущен. Интервал между запусками: случайный 1–4 часа")
-    print("Для остановки нажмите Ctrl+C\n")
-
-    last_status_print = datetime.now()
-
-    try:
-        while not exit_controller.exit_now:
-            # Проверяем, наступило ли время следующего запуска
-            if next_run and datetime.now() >= next_run:
-                print(f"\n[{datetime.now().strftime('%Y-%m-%d %H:%M:%S')}] Наступило время запуска.")
-                job_success = job(publisher, CHANNEL_USERNAME, exit_controller)
-
-                if not exit_controller.exit_now:
-                    # Пересчитываем следующий интервал
-                    interval_seconds = random.randint(3600, 14400)
-                    next_run = datetime.now() + timedelta(seconds=interval_seconds)
-                    print(f"\nСледующий запуск через {interval_seconds // 3600} ч {interval_seconds % 3600 // 60} мин")
-                    print(f"Ожидание до {next_run.strftime('%Y-%m-%d %H:%M:%S')}")
-                    last_status_print = datetime.now()  # сбросим таймер печати статуса
-
-            # Печатаем "пульс" раз в 5 минут, чтобы было видно, что скрипт жив
-            now = datetime.now()
-            if (now - last_status_print).seconds > 300:
-                if next_run:
-                    remaining = (next_run - now).total_seconds()
-                    if remaining > 0:
-                        hours = int(remaining // 3600)
-                        minutes = int((remaining % 3600) // 60)
-                        print(f"[{now.strftime('%H:%M:%S')}] До следующего запуска: {hours} ч {minutes} мин")
-                last_status_print = now
-
-            time.sleep(1)  # ждём 1 секунду перед новой проверкой
-
+        if ARGS.once:
+            exit_code = 0 if run_cycle(publisher, db.router.channels, exit_controller, db, parser, FETCH_JOBS) else 1
+        else:
+            scheduler.run()
     except KeyboardInterrupt:
-        print("\nПолучен сигнал прерывания...")
+        log(logging.INFO, "\nПолучен сигнал прерывания...")
     finally:
-        print("\n" + "=" * 60)
-        print("Агрегатор завершает работу...")
-        print("Спасибо за использование!")
-        print("=" * 60)
+        db.close()
+        log(logging.INFO, "HTTP-кеш: {stats}", stats=HTTP_CACHE.stats())
+        HTTP_CACHE.close()
+        log_separator()
+        log(logging.INFO, "Агрегатор завершает работу...\nСпасибо за использование!")
+        log_separator()
+    sys.exit(exit_code)
@@ -0,0 +1,89 @@
+import os
+import tempfile
+import unittest
+
+import main
+from benchmark import synthetic_vacancies
+
+# Регрессия планов запросов: горячие методы VacancyDatabase вызываются по-настоящему, их SQL
+# перехватывается trace-колбэком и прогоняется через EXPLAIN QUERY PLAN.
+#
+#   python -m pytest -q test_query_plans.py
+
+
+def traced_statements(conn, call):
+    # SQL, который реально выполнил метод, с подставленными параметрами
+    statements = []
+    conn.set_trace_callback(statements.append)
+    try:
+        call()
+    finally:
+        conn.set_trace_callback(None)
+    seen = []
+    for sql in statements:
+        if sql.split(None, 1)[0].upper() in ("SELECT", "INSERT", "UPDATE", "DELETE", "WITH") and sql not in seen:
+            seen.append(sql)
+    return seen
+
+
+class QueryPlanTest(unittest.TestCase):
+    def setUp(self):
+        self.workdir = tempfile.TemporaryDirectory()
+        self.db = main.VacancyDatabase(os.path.join(self.workdir.name, "plans.db"),
+                                       router=main.ChannelRouter([main.ChannelRule("@bench")]))
+        self.vacancies = synthetic_vacancies(main.HHruParser(), 1000)
+        self.db.save_vacancies(self.vacancies[1:])
+        self.conn = self.db.connections.connection()
+
+    def tearDown(self):
+        self.db.close()
+        self.workdir.cleanup()
+
+    def plans(self, call):
+        return [(sql, [row[3] for row in self.conn.execute("EXPLAIN QUERY PLAN " + sql)])
+                for sql in traced_statements(self.conn, call)]
+
+    def assertPlans(self, call, index, ordered_scan=False):
+        # Каждый запрос идёт по индексу: полный SCAN таблицы и сортировка во временном B-дереве
+        # запрещены. ordered_scan - обход индекса index в порядке ORDER BY ... LIMIT по частичному
+        # индексу, где каждая строка подходит и обход останавливается на LIMIT
+        plans = self.plans(call)
+        self.assertTrue(plans, "метод не выполнил ни одного запроса")
+        for sql, plan in plans:
+            for step in plan:
+                self.assertNotIn("TEMP B-TREE", step, sql)
+                if step.startswith("SCAN "):
+                    self.assertTrue(ordered_scan and index in step, f"{step}\n{sql}")
+        self.assertTrue(any(index in step for _, plan in plans for step in plan), plans)
+
+    def test_save_vacancies(self):
+        self.assertPlans(lambda: self.db.save_vacancies(self.vacancies[:1]), "idx_fingerprint")
+
+    def test_get_unposted_vacancies(self):
+        self.assertPlans(lambda: self.db.get_unposted_vacancies(10), "idx_unposted_published", ordered_scan=True)
+
+    def test_get_channel_queue(self):
+        self.assertPlans(lambda: self.db.get_channel_queue("@bench", 10), "idx_channel_queue")
+
+    def test_count_channel_queue(self):
+        self.assertPlans(lambda: self.db.count_channel_queue("@bench"), "idx_channel_queue")
+
+    def test_claim_channel_post(self):
+        self.assertPlans(lambda: self.db.claim_channel_post("@bench", "bench"), "idx_channel_queue")
+
+    def test_cleanup_old_vacancies(self):
+        archive = main.VacancyArchive(os.path.join(self.workdir.name, "archive"))
+        self.assertPlans(lambda: self.db.cleanup_old_vacancies(30, archive=archive), "idx_published_ts")
+
+    def test_salary_histogram(self):
+        self.assertPlans(lambda: self.db.salary_histogram("city", "Пермь"), "PRIMARY KEY")
+
+    def test_unenriched_ids(self):
+        self.assertPlans(lambda: self.db.unenriched_ids(10), "idx_details_pending", ordered_scan=True)
+
+    def test_update_currency_rates(self):
+        self.assertPlans(lambda: self.db.update_currency_rates({"USD": 0.0125}), "idx_salary_unconverted")
+
+
+if __name__ == "__main__":
+    unittest.main()